@@ -1,26 +1,349 @@
 """ Implements the Flask web app for CS50 Finance. """
 
+import time
+
+# Recorded before the heavier imports below so cold start includes them,
+# where the process's own start time cannot be read
+STARTED = time.perf_counter()
+
+import csv
+import json
 from decimal import Decimal
 import re
-import os
 import os.path
-from datetime import datetime
-from tempfile import mkdtemp
-from flask import Flask, flash, redirect, render_template, request, session
+from datetime import datetime, timedelta
+from flask import (Blueprint, Flask, Response, abort, current_app, flash,
+                   jsonify, redirect, render_template, request,
+                   send_from_directory, session)
 from flask_session import Session
-from flask_sqlalchemy import SQLAlchemy
+import click
 from sqlalchemy import exc
 from werkzeug.exceptions import default_exceptions
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from helpers import apology, login_required, lookup, usd, f_time, f_date
-
-# Configure application
-app = Flask(__name__)
+from database import database_config, read_only
+from idempotency import idempotent, new_key, record
+from ledger import (backfill, post_cash, post_opening, post_trade,
+                    reconcile)
+from helpers import (Deferred, apology, login_required, lookup, usd, f_time,
+                     f_date, process_age)
+from orders import KINDS, SIDES, OrderEngine
+from shared import QuoteCache, RateLimiter, SharedStore
+from streaming import PriceHub, portfolio_events
+from symbols import SymbolDirectory
+from models import (db, bootstrap, delete_orphan_stocks, delete_user_rows,
+                    transaction_type_id, Order, User, Portfolio, Stock,
+                    Transaction)
+
+# Routes are registered on a blueprint and attached to an app in create_app()
+bp = Blueprint("finance", __name__)
+
+
+def create_app(config=None):
+    """Create and configure an instance of the app.
+
+    No database access happens here, tables and reference data are created by
+    running `flask init-db` once before serving.
+    """
+
+    # Configure application
+    app = Flask(__name__)
+
+    # Configure session to use the shared store (instead of signed cookies)
+    app.config["SESSION_PERMANENT"] = False
+    app.config["SESSION_TYPE"] = "cachelib"
+
+    # SQLite file holding the sessions, quote cache and rate limits shared
+    # by every worker process, see shared.py
+    app.config["SHARED_STORE"] = os.path.join(os.getcwd(), "shared.db")
+
+    # Seconds a quote is reused before looking it up again
+    app.config["QUOTE_CACHE_TTL"] = 10
+
+    # Login attempts allowed per client address per minute
+    app.config["LOGIN_RATE_LIMIT"] = 10
+
+    # Reverse proxies in front of the app, whose X-Forwarded-For headers are
+    # trusted for the client's address
+    app.config["PROXY_HOPS"] = int(os.environ.get("PROXY_HOPS", 0))
+
+    # How long a trade submission's idempotency key is remembered
+    app.config["IDEMPOTENCY_TTL"] = timedelta(days=1)
+
+    # Lock held by the one process that executes resting orders
+    app.config["ORDER_ENGINE_LOCK"] = os.path.join(os.getcwd(),
+                                                   "order-engine.lock")
+
+    # Configure the database backend from the environment, see database.py
+    app.config.update(database_config())
+
+    # Choose the live quote providers or a simulated market, whose other
+    # settings are read by market.py only when it is used
+    app.config["QUOTE_PROVIDER"] = os.environ.get("QUOTE_PROVIDER", "live")
+
+    # Target time in milliseconds from process start to first request served.
+    # Starting Python and importing Flask and SQLAlchemy alone take about
+    # 550 ms on one slow CPU, leaving 200 ms for the app's own imports, setup
+    # and first request.
+    app.config["STARTUP_TARGET_MS"] = 750
+
+    # Seconds between polls of each symbol watched over /stream
+    app.config["PRICE_STREAM_INTERVAL"] = 15
+
+    # Listing of known symbols, unknown symbols are rejected without a
+    # quote lookup when strict. The bundled listing is far from complete, so
+    # strict is the default only once a full listing is configured.
+    app.config["SYMBOL_LISTING"] = os.environ.get(
+        "SYMBOL_LISTING", os.path.join(app.root_path, "data", "symbols.csv"))
+    app.config["SYMBOL_DIRECTORY_STRICT"] = os.environ.get(
+        "SYMBOL_DIRECTORY_STRICT",
+        "1" if "SYMBOL_LISTING" in os.environ else "0") != "0"
+
+    # Directory of the per-symbol price history columns
+    app.config["BARS_DIR"] = os.path.join(os.getcwd(), "bars")
+
+    # Number of users shown on the leaderboard
+    app.config["LEADERBOARD_SIZE"] = 20
+
+    # SQLite file of background jobs, the worker threads each process runs
+    # and the most jobs of each kind running at once across processes, any
+    # of them given in JOBS_LIMITS as JSON, like {"statement": 4}
+    app.config["JOBS_DB"] = os.environ.get(
+        "JOBS_DB", os.path.join(os.getcwd(), "jobs.db"))
+    app.config["JOBS_WORKERS"] = int(os.environ.get("JOBS_WORKERS", 2))
+    app.config["JOBS_LIMITS"] = {"statement": 2, "export": 1,
+                                 "reconcile": 1}
+    app.config["JOBS_LIMITS"].update(
+        json.loads(os.environ.get("JOBS_LIMITS", "{}")))
+
+    # Directory of the transaction exports built by jobs
+    app.config["EXPORTS_DIR"] = os.environ.get(
+        "EXPORTS_DIR", os.path.join(os.getcwd(), "exports"))
+
+    if config:
+        app.config.update(config)
+
+    if app.config["PROXY_HOPS"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_HOPS"],
+                                x_proto=app.config["PROXY_HOPS"])
+
+    app.extensions["shared"] = SharedStore(app.config["SHARED_STORE"])
+    app.config.setdefault("SESSION_CACHELIB", app.extensions["shared"])
+
+    Session(app)
+    db.init_app(app)
+
+    # Under gevent each request has its own connection to the shared store,
+    # which would otherwise stay open as long as a /stream client does
+    @app.teardown_request
+    def close_shared(exception):
+        app.extensions["shared"].close()
+
+    # Custom filters
+    app.jinja_env.filters["usd"] = usd
+    app.jinja_env.filters["f_time"] = f_time
+    app.jinja_env.filters["f_date"] = f_date
+    app.jinja_env.globals["idempotency_key"] = new_key
+
+    app.register_blueprint(bp)
+
+    # Quote from the live providers, or the simulated market for testing
+    if app.config["QUOTE_PROVIDER"] == "simulated":
+        from market import SimulatedMarket, market_config
+        for key, value in market_config().items():
+            app.config.setdefault(key, value)
+        app.extensions["market"] = SimulatedMarket(
+            app.config["SYMBOL_LISTING"], app.config["MARKET_SYMBOLS"],
+            seed=app.config["MARKET_SEED"],
+            volatility=app.config["MARKET_VOLATILITY"],
+            tick=app.config["MARKET_TICK"],
+            latency=app.config["MARKET_LATENCY"],
+            error_rate=app.config["MARKET_ERROR_RATE"])
+        provider = app.extensions["market"]
+    elif app.config["QUOTE_PROVIDER"] == "live":
+        provider = lookup
+    else:
+        raise ValueError("QUOTE_PROVIDER must be live or simulated, not "
+                         f"{app.config['QUOTE_PROVIDER']}")
+
+    # Quotes and login attempts are counted across every worker process
+    app.extensions["quotes"] = QuoteCache(
+        app.extensions["shared"], provider, app.config["QUOTE_CACHE_TTL"])
+    app.extensions["login_limiter"] = RateLimiter(
+        app.extensions["shared"], app.config["LOGIN_RATE_LIMIT"])
+
+    # One price hub per process, shared by every client of /stream
+    app.extensions["price_hub"] = PriceHub(
+        app.extensions["quotes"],
+        interval=app.config["PRICE_STREAM_INTERVAL"], logger=app.logger)
+
+    # The optional subsystems below are only imported and built on first
+    # use, to keep them out of cold start
+
+    # Record minute bars of the prices the hub sees
+    def bar_store():
+        from timeseries import BarStore
+        return BarStore(app.config["BARS_DIR"])
+
+    def bar_recorder():
+        from timeseries import BarRecorder
+        return BarRecorder(app.extensions["bars"].unwrap(), time.time)
+
+    app.extensions["bars"] = Deferred(bar_store)
+    app.extensions["price_hub"].listeners.append(Deferred(bar_recorder))
+
+    # Daily total assets of each user, valued from the price history
+    def equity_curves():
+        from equity import EquityCurves
+        return EquityCurves(app.extensions["bars"].unwrap())
+
+    app.extensions["equity"] = Deferred(equity_curves)
+
+    # Users ranked by total assets, loaded on first use then kept current by
+    # committed trades and by the prices of held stocks
+    def leaderboard():
+        from leaderboard import Leaderboard
+        return Leaderboard(app.extensions["price_hub"].watch)
+
+    def rank_price(symbol, price):
+        # Until the leaderboard is loaded it has no holders to mark
+        if app.extensions["leaderboard"].built:
+            app.extensions["leaderboard"].price(symbol, price)
+
+    app.extensions["leaderboard"] = Deferred(leaderboard)
+    app.extensions["price_hub"].listeners.append(rank_price)
+
+    # The symbol directory is read on first use
+    app.extensions["symbols"] = SymbolDirectory(
+        app.config["SYMBOL_LISTING"],
+        app.extensions["market"].names if "market" in app.extensions else None)
+
+    # Resting orders are loaded and watched from the first request on, by
+    # only one worker process at a time
+    app.extensions["order_engine"] = OrderEngine(
+        app, app.extensions["price_hub"], execute_order,
+        app.config["ORDER_ENGINE_LOCK"], app.config["PRICE_STREAM_INTERVAL"])
+
+    @app.before_request
+    def start_order_engine():
+        app.extensions["order_engine"].start()
+
+    # Statements, exports and reconciliation run off the request path
+    def job_queue():
+        from jobs import JobQueue
+        from statements import export_transactions, monthly_statement
+        return JobQueue(
+            app.config["JOBS_DB"], app,
+            {"statement": monthly_statement, "export": export_transactions,
+             "reconcile": reconcile_job},
+            workers=app.config["JOBS_WORKERS"],
+            limits=app.config["JOBS_LIMITS"])
+
+    # Built, and its worker threads started, only once the Statements page
+    # is used, so that other requests never import or start it
+    app.extensions["jobs"] = Deferred(job_queue)
+
+    # listen for errors
+    for code in default_exceptions:
+        app.errorhandler(code)(errorhandler)
+
+    # Measure cold start to first request
+    first_request = []
+
+    @app.before_request
+    def log_startup_time():
+        if first_request:
+            return
+        first_request.append(True)
+        age = process_age()
+        if age is None:
+            age = time.perf_counter() - STARTED
+        elapsed = age * 1000
+        if elapsed > app.config["STARTUP_TARGET_MS"]:
+            app.logger.warning("Cold start to first request took %.0f ms, "
+                               "target is %d ms", elapsed,
+                               app.config["STARTUP_TARGET_MS"])
+        else:
+            app.logger.info("Cold start to first request took %.0f ms",
+                            elapsed)
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create the tables, seed the reference data and migrate."""
+        from migrations import upgrade
+        bootstrap()
+        upgrade()
+        print("Initialized the database.")
+
+    @app.cli.command("ledger-backfill")
+    def ledger_backfill_command():
+        """Post ledger entries for users who predate the ledger."""
+        print(f"Backfilled {backfill()} users.")
+
+    @app.cli.command("ledger-reconcile")
+    @click.option("--background", is_flag=True,
+                  help="Queue the reconciliation as a job instead.")
+    def ledger_reconcile_command(background):
+        """Check cash and portfolios against the ledger and checkpoint."""
+        if background:
+            job_id = app.extensions["jobs"].submit("reconcile")
+            print(f"Queued job {job_id}.")
+            return
+        problems = reconcile()
+        for user_id, problem in problems:
+            print(f"user {user_id}: {problem}")
+        print(f"{len(problems)} problems found.")
+
+    @app.cli.command("bars-import")
+    @click.argument("symbol")
+    @click.argument("path", type=click.File())
+    def bars_import_command(symbol, path):
+        """Append minute bars for SYMBOL from a CSV file at PATH.
+
+        The CSV has columns time (seconds since the epoch), open, high, low,
+        close and volume.
+        """
+        bars = ((int(row["time"]), float(row["open"]), float(row["high"]),
+                 float(row["low"]), float(row["close"]), int(row["volume"]))
+                for row in csv.DictReader(path))
+        app.extensions["bars"].append(symbol, bars)
+
+    @app.cli.command("jobs-worker")
+    def jobs_worker_command():
+        """Run queued jobs in this process until interrupted."""
+        jobs = app.extensions["jobs"].unwrap()
+        jobs.workers = jobs.workers or 1
+        jobs.start()
+        print(f"Running jobs with {jobs.workers} workers.")
+        while True:
+            time.sleep(60)
+
+    @app.cli.command("db-upgrade")
+    def db_upgrade_command():
+        """Apply any schema migrations not yet applied."""
+        from migrations import upgrade
+        applied = upgrade()
+        print(f"Applied migrations: {applied}" if applied
+              else "Database is up to date.")
+
+    @app.cli.command("db-explain")
+    def db_explain_command():
+        """Show the query plan for each hot query and check its index."""
+        from migrations import explain_hot_queries
+        for route, sql, index, plan, ok in explain_hot_queries():
+            print(f"{'OK  ' if ok else 'SCAN'} {route}: {sql}\n     {plan}")
+
+    return app
+
+
+def quote_lookup(symbol):
+    """Look up a quote, shared with other workers for a few seconds."""
+    return current_app.extensions["quotes"](symbol)
 
 
 # Ensure responses aren't cached
-@app.after_request
+@bp.after_app_request
 def after_request(response):
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
@@ -28,152 +351,9 @@ def after_request(response):
     return response
 
 
-# Custom filters
-app.jinja_env.filters["usd"] = usd
-app.jinja_env.filters["f_time"] = f_time
-app.jinja_env.filters["f_date"] = f_date
-
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
-
-# Configure SQLite database using flask_sqlalchemy.SQLAlchemy
-db_filename = "finance.db"
-db_path = os.path.join(os.getcwd(), db_filename)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_path
-app.config["SQLALCHEMY_ECHO"] = True
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
-db = SQLAlchemy(app)
-
-
-class User(db.Model):
-    """The users table in our database."""
-
-    __tablename__ = "users"
-    id = db.Column(db.Integer, primary_key=True, nullable=False)
-    username = db.Column(db.Text, nullable=False, unique=True)
-    hash = db.Column(db.Text, nullable=False)
-    cash = db.Column(db.Text, nullable=False, default="10000")
-
-    transactions = db.relationship("Transaction", back_populates="user",
-                                   cascade="all, delete-orphan")
-    portfolio = db.relationship("Portfolio", back_populates="user",
-                                cascade="all, delete-orphan")
-
-    def __repr__(self):
-        return (f"<User(id={self.id}, username={self.username}, "
-                f"hash={self.hash}, cash={self.cash})>")
-
-
-class Portfolio(db.Model):
-    """The portfolios table in our database"""
-
-    __tablename__ = "portfolios"
-    id = db.Column(db.Integer, primary_key=True, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    stock_id = db.Column(db.Integer, db.ForeignKey('stocks.id'),
-                         nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-
-    user = db.relationship("User", back_populates="portfolio")
-    stock = db.relationship("Stock", back_populates="portfolios")
-
-    def __repr__(self):
-        return (f"<Portfolio(id={self.id}, user_id={self.user_id}, "
-                f"stock_id={self.stock_id}, quantity={self.quantity})>")
-
-
-class Stock(db.Model):
-    """The stocks table in our database."""
-
-    __tablename__ = "stocks"
-    id = db.Column(db.Integer, primary_key=True, nullable=False)
-    symbol = db.Column(db.Text, unique=True)
-    name = db.Column(db.Text, unique=True)
-
-    transactions = db.relationship("Transaction", back_populates="stock")
-    portfolios = db.relationship("Portfolio", back_populates="stock")
-
-    def __repr__(self):
-        return f"<Stock(id={self.id}, symbol={self.symbol})>"
-
-
-class TransactionType(db.Model):
-    """The table for the three types of transactions in our database"""
-
-    __tablename__ = "transaction_types"
-    id = db.Column(db.Integer, primary_key=True, nullable=False)
-    name = db.Column(db.Text, unique=True)
-
-    transactions = db.relationship("Transaction", back_populates="ttype")
-
-    def __repr__(self):
-        return f"<TransactionType(id={self.id}, name={self.name}>"
-
-
-class Transaction(db.Model):
-    """The Transactions table in our database."""
-
-    __tablename__ = "transactions"
-    id = db.Column(db.Integer, primary_key=True, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    stock_id = db.Column(db.Integer, db.ForeignKey('stocks.id'),
-                         nullable=False)
-    type_id = db.Column(db.Integer, db.ForeignKey('transaction_types.id'),
-                        nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-    price = db.Column(db.Text, nullable=False)
-    datetime = db.Column(db.DateTime, nullable=False)
-
-    user = db.relationship("User", back_populates="transactions")
-    stock = db.relationship("Stock", back_populates="transactions")
-    ttype = db.relationship("TransactionType", back_populates="transactions")
-
-    def __repr__(self):
-        return (f"<Transaction(id={self.id}, user_id={self.user_id}, "
-                f"stock_id={self.stock_id}, "
-                f"type_id={self.type_id}, "
-                f"quantity={self.quantity}, price={self.price}, "
-                f"datetime={self.datetime})>")
-
-
-# Create database tables if not already existing.
-db.create_all()
-
-"""
-# For testing and initialization
-db.drop_all()
-db.create_all()
-# Create some example rows.
-a = User(username="a", hash=generate_password_hash("a"))
-b = User(username="b", hash=generate_password_hash("b"))
-c = User(username="c", hash=generate_password_hash("c"))
-d = User(username="d", hash=generate_password_hash("d"))
-db.session.add_all([a,b,c,d])
-"""
-
-# Add, if not already existing, the three transaction types the database allows
-if not TransactionType.query.filter_by(name="BUY").first():
-    db.session.add(TransactionType(name="BUY"))
-
-if not TransactionType.query.filter_by(name="SELL").first():
-    db.session.add(TransactionType(name="SELL"))
-
-if not TransactionType.query.filter_by(name="CASH").first():
-    db.session.add(TransactionType(name="CASH"))
-
-# Commit changes
-try:
-    db.session.commit()
-except exc.SQLAlchemyError:
-    db.session.rollback()
-
-
-
-@app.route("/")
+@bp.route("/")
 @login_required
+@read_only
 def index():
     """Show portfolio of stocks"""
 
@@ -187,7 +367,7 @@ def index():
     for item in user.portfolio:
 
         # Lookup the current price
-        quoted = lookup(item.stock.symbol)
+        quoted = quote_lookup(item.stock.symbol)
 
         if quoted:
             price = quoted["price"]
@@ -196,8 +376,8 @@ def index():
             # If lookup failed use price from most recent transaction for any
             # user
             price = db.session.query(Transaction.price).\
-                    filter(Transaction.stock.symbol == item.stock.symbol).\
-                    order_by(Transaction.datetime.desc()).first()
+                    filter(Transaction.stock_id == item.stock_id).\
+                    order_by(Transaction.datetime.desc()).scalar()
 
         # Calculate subtotal for row
         subtotal = Decimal(price) * Decimal(item.quantity)
@@ -214,8 +394,69 @@ def index():
     return render_template("index.html", table=table, cash=cash, total=total)
 
 
-@app.route("/buy", methods=["GET", "POST"])
+@bp.route("/stream")
+@login_required
+@read_only
+def stream():
+    """Stream changes in price and value of the user's portfolio"""
+
+    # Query for user
+    user = User.query.filter_by(id=session["user_id"]).first()
+
+    # Read everything needed now, the stream outlives the request
+    holdings = {item.stock.symbol: item.quantity for item in user.portfolio}
+    cash = float(user.cash)
+
+    hub = current_app.extensions["price_hub"]
+    return Response(portfolio_events(hub, holdings, cash),
+                    mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+@bp.route("/chart")
+@login_required
+def chart():
+    """Show a price chart for a stock in the user's portfolio"""
+
+    symbol = request.args.get("symbol", "")
+    if not holds(symbol):
+        flash("403 Forbidden")
+        return apology(f"yeah, if you owned any {symbol} shares", 403)
+
+    return render_template("chart.html", symbol=symbol.upper())
+
+
+@bp.route("/bars")
+@login_required
+def bars():
+    """Return price history for a stock in the user's portfolio as JSON"""
+
+    symbol = request.args.get("symbol", "")
+    if not holds(symbol):
+        return jsonify(error="not in portfolio"), 403
+
+    # Default to the last 30 days at up to 500 points
+    end = request.args.get("end", int(time.time()), type=int)
+    start = request.args.get("start", end - 30 * 24 * 60 * 60, type=int)
+    points = min(request.args.get("points", 500, type=int), 5000)
+
+    rows = current_app.extensions["bars"].downsample(symbol, start, end,
+                                                     max(points, 1))
+    return jsonify([dict(zip(("time", "open", "high", "low", "close",
+                              "volume"), row)) for row in rows])
+
+
+def holds(symbol):
+    """Return whether the user has symbol in their portfolio"""
+
+    return Portfolio.query.join(Stock).filter(
+        Portfolio.user_id == session["user_id"],
+        Stock.symbol == symbol.upper()).first() is not None
+
+
+@bp.route("/buy", methods=["GET", "POST"])
 @login_required
+@idempotent
 def buy():
     """Buy shares of stock"""
 
@@ -237,9 +478,13 @@ def buy():
         error = ("yeah, if you could provide a positive whole number of "
                  "shares")
 
+    # Check the symbol is listed before looking it up
+    elif unlisted(symbol):
+        error = f"yeah, if {symbol} could be a listed symbol"
+
     else:
         # Lookup a quote for symbol
-        quoted = lookup(symbol)
+        quoted = quote_lookup(symbol)
 
         # Failed lookup
         if quoted is None:
@@ -251,68 +496,42 @@ def buy():
         return apology(error, 403)
 
     # Compute cost of purchase as decimal
-    price = str(quoted["price"])
     quantity = int(shares)
-    cost = Decimal(quantity) * Decimal(price)
+    cost = Decimal(quantity) * Decimal(str(quoted["price"]))
 
-    # Check user can afford purchase
-    user = User.query.filter_by(id=session["user_id"]).first()
+    # Check user can afford purchase, locking the user's row where the
+    # database supports it until the trade commits
+    user = User.query.filter_by(id=session["user_id"]).\
+        with_for_update().first()
 
     if Decimal(user.cash) < cost:
         flash("403 Forbidden")
         return apology("yeah, if you could try to not go overdrawn", 403)
 
-    # Find the stock in the stocks table
-    stock = Stock.query.filter_by(symbol=symbol.upper()).first()
-
-    # Or else add the stock to the stocks table
-    if not stock:
-        stock = Stock(symbol=symbol.upper(), name=quoted["name"])
-        try:
-            db.session.add(stock)
-            db.session.commit()
-        except exc.SQLAlchemyError:
-            db.session.rollback()
-            flash("500 Internal Server Error")
-            return apology("yeah, if the server could work properly", 500)
-
-    # Create the row for the transactions table
-    buy_type = TransactionType.query.filter_by(name="BUY").first()
-    db.session.add(Transaction(user_id=user.id, stock_id=stock.id,
-                               type_id=buy_type.id, quantity=quantity,
-                               price=price, datetime=datetime.now()))
-
-    # Look for any row for this user and symbol in portfolios table
-    portfolio_row = Portfolio.query.filter_by(user_id=user.id,
-                                              stock_id=stock.id).first()
-
-    # If the entry does not exist, create it
-    if not portfolio_row:
-        db.session.add(Portfolio(user_id=user.id, stock_id=stock.id,
-                                 quantity=quantity))
-    # Otherwise update the existing entry
-    else:
-        portfolio_row.quantity += quantity
-
-    # Finally update the users cash, subtract from existing cash and convert
-    # back to string for storage
-    user.cash = str(Decimal(user.cash) - cost)
-
-    # Try to commit changes
+    # Try to record the purchase, and the response repeats of this
+    # submission get, and commit changes
+    response = redirect("/")
     try:
+        buy_shares(user, symbol.upper(), quoted["name"], quantity,
+                   quoted["price"])
+        record(response)
         db.session.commit()
     except exc.SQLAlchemyError:
         db.session.rollback()
         flash("500 Internal Server Error")
         return apology("yeah, if the server could work properly", 500)
 
+    # List the stock for autocomplete if the listing file lacks it
+    current_app.extensions["symbols"].add(symbol.upper(), quoted["name"])
+
     # Redirect user to home page
     flash("Purchase complete")
-    return redirect("/")
+    return response
 
 
-@app.route("/history")
+@bp.route("/history")
 @login_required
+@read_only
 def history():
     """Show history of transactions"""
 
@@ -356,7 +575,55 @@ def history():
     return render_template("history.html", table=reversed(table))
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/performance")
+@login_required
+def performance():
+    """Show the user's total assets over time"""
+
+    return render_template("performance.html")
+
+
+@bp.route("/equity")
+@login_required
+@read_only
+def equity():
+    """Return the user's total assets at the end of each day as JSON"""
+
+    curve = current_app.extensions["equity"].curve(session["user_id"])
+    return jsonify([{"date": day.isoformat(), "total": total}
+                    for day, total in curve])
+
+
+@bp.route("/leaderboard")
+@login_required
+@read_only
+def leaderboard():
+    """Show the users with the most total assets and the user's own rank"""
+
+    # The ranking takes a while to load at first, off the request path
+    board = current_app.extensions["leaderboard"]
+    if not board.loaded:
+        board.start(current_app._get_current_object())
+        return render_template("leaderboard.html", loading=True)
+
+    while True:
+        leaders = board.top(current_app.config["LEADERBOARD_SIZE"])
+        names = dict(db.session.query(User.id, User.username).
+                     filter(User.id.in_([user_id for user_id, _ in leaders])))
+
+        # Drop any users deleted through another worker process
+        if len(names) == len(leaders):
+            break
+        for user_id, _ in leaders:
+            if user_id not in names:
+                board.remove(user_id)
+    table = [{"rank": rank, "username": names.get(user_id), "total": total}
+             for rank, (user_id, total) in enumerate(leaders, 1)]
+    return render_template("leaderboard.html", table=table,
+                           mine=board.rank(session["user_id"]))
+
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
 
@@ -367,6 +634,11 @@ def login():
     if request.method == "GET":
         return render_template("login.html")
 
+    # Slow down password guessing from any one address
+    if not current_app.extensions["login_limiter"].hit(request.remote_addr):
+        flash("429 Too Many Requests")
+        return apology("yeah, if you could wait a minute and try again", 429)
+
     # User reached route via POST (as by submitting a form via POST)
     username = request.form.get("username")
     password = request.form.get("password")
@@ -400,7 +672,7 @@ def login():
     return redirect("/")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     """Log user out"""
 
@@ -412,8 +684,9 @@ def logout():
     return render_template("exited.html")
 
 
-@app.route("/quote", methods=["GET", "POST"])
+@bp.route("/quote", methods=["GET", "POST"])
 @login_required
+@read_only
 def quote():
     """Get stock quote."""
 
@@ -429,9 +702,13 @@ def quote():
     if not symbol:
         error = "yeah, if you could provide a symbol"
 
+    # Check the symbol is listed before looking it up
+    elif unlisted(symbol):
+        error = f"yeah, if {symbol} could be a listed symbol"
+
     else:
         # Lookup a quote for symbol
-        quoted = lookup(symbol)
+        quoted = quote_lookup(symbol)
 
         # Check we got a quote back
         if quoted is None:
@@ -444,7 +721,24 @@ def quote():
     return render_template("quoted.html", quote=quoted)
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/symbols")
+@login_required
+def symbols():
+    """Suggest listed symbols matching the start of a symbol or name"""
+
+    query = request.args.get("q", "")
+    return jsonify(current_app.extensions["symbols"].search(query))
+
+
+def unlisted(symbol):
+    """Return whether symbol should be rejected as not listed"""
+
+    if not current_app.config["SYMBOL_DIRECTORY_STRICT"]:
+        return False
+    return not current_app.extensions["symbols"].known(symbol)
+
+
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     """Register user"""
 
@@ -495,6 +789,7 @@ def register():
     new_user = User(username=username, hash=generate_password_hash(password))
     try:
         db.session.add(new_user)
+        post_opening(new_user)
         db.session.commit()
     except exc.SQLAlchemyError:
         db.session.rollback()
@@ -511,13 +806,18 @@ def register():
     return redirect("/")
 
 
-@app.route("/sell", methods=["GET", "POST"])
+@bp.route("/sell", methods=["GET", "POST"])
 @login_required
+@idempotent
 def sell():
     """Sell shares of stock"""
 
-    # Query for the user
-    user = User.query.filter_by(id=session["user_id"]).first()
+    # Query for the user, locking the row for a sale where the database
+    # supports it
+    user = User.query.filter_by(id=session["user_id"])
+    if request.method == "POST":
+        user = user.with_for_update()
+    user = user.first()
 
     # User reached route via GET (as by clicking a link or via redirect)
     if request.method == "GET":
@@ -559,7 +859,7 @@ def sell():
 
         else:
             # Lookup a quote for symbol
-            quoted = lookup(symbol)
+            quoted = quote_lookup(symbol)
 
             # Failed lookup
             if quoted is None:
@@ -570,19 +870,82 @@ def sell():
         flash("403 Forbidden")
         return apology(error, 403)
 
+    # Try to record the sale, and the response repeats of this submission
+    # get, and commit changes
+    response = redirect("/")
+    try:
+        sell_shares(user, portfolio, int(shares), quoted["price"])
+        record(response)
+        db.session.commit()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        flash("500 Internal Server Error")
+        return apology("yeah, if the server could work properly", 500)
+
+    # Redirect user to home page
+    flash("Sale complete")
+    return response
+
+
+def buy_shares(user, symbol, name, quantity, price):
+    """Record a purchase, the caller checks affordability and commits"""
+
+    # Compute cost of purchase as decimal
+    price = str(price)
+    cost = Decimal(quantity) * Decimal(price)
+
+    # Find the stock in the stocks table
+    stock = Stock.query.filter_by(symbol=symbol).first()
+
+    # Or else add the stock to the stocks table
+    if not stock:
+        stock = Stock(symbol=symbol, name=name)
+        db.session.add(stock)
+        db.session.flush()
+
+    # Create the row for the transactions table
+    transaction = Transaction(user_id=user.id, stock_id=stock.id,
+                              type_id=transaction_type_id("BUY"),
+                              quantity=quantity, price=price,
+                              datetime=datetime.now())
+    db.session.add(transaction)
+    post_trade(transaction, quantity, cost)
+
+    # Look for any row for this user and symbol in portfolios table
+    portfolio_row = Portfolio.query.filter_by(user_id=user.id,
+                                              stock_id=stock.id).\
+        with_for_update().first()
+
+    # If the entry does not exist, create it
+    if not portfolio_row:
+        db.session.add(Portfolio(user_id=user.id, stock_id=stock.id,
+                                 quantity=quantity))
+    # Otherwise update the existing entry
+    else:
+        portfolio_row.quantity += quantity
+
+    # Finally update the users cash, subtract from existing cash and convert
+    # back to string for storage
+    user.cash = str(Decimal(user.cash) - cost)
+
+
+def sell_shares(user, portfolio, quantity_sold, price):
+    """Record a sale, the caller checks enough shares are owned and commits"""
+
     # Compute profit of sale as decimal
-    price = str(quoted["price"])
-    quantity_sold = int(shares)
+    price = str(price)
     profit = Decimal(quantity_sold) * Decimal(price)
 
     # Update the user's cash
     user.cash = str(Decimal(user.cash) + profit)
 
     # Create the row for the transactions table
-    sell_type = TransactionType.query.filter_by(name="SELL").first()
-    db.session.add(Transaction(user_id=user.id, stock_id=portfolio.stock.id,
-                               type_id=sell_type.id, quantity=quantity_sold,
-                               price=price, datetime=datetime.now()))
+    transaction = Transaction(user_id=user.id, stock_id=portfolio.stock.id,
+                              type_id=transaction_type_id("SELL"),
+                              quantity=quantity_sold, price=price,
+                              datetime=datetime.now())
+    db.session.add(transaction)
+    post_trade(transaction, -quantity_sold, -profit)
 
     # Update number of shares owned
     portfolio.quantity -= quantity_sold
@@ -593,29 +956,231 @@ def sell():
         # Delete the portfolio row
         db.session.delete(portfolio)
 
-    # Try to commit changes
+
+@bp.route("/orders", methods=["GET", "POST"])
+@login_required
+def orders():
+    """Place and list limit and stop orders"""
+
+    # User reached route via GET (as by clicking a link or via redirect)
+    if request.method == "GET":
+        rows = Order.query.filter_by(user_id=session["user_id"]).\
+            order_by(Order.id.desc()).all()
+        return render_template("orders.html", orders=rows)
+
+    # User reached route via POST (as by submitting a form via POST)
+    symbol = request.form.get("symbol")
+    shares = request.form.get("shares")
+    side = request.form.get("side")
+    kind = request.form.get("kind")
+    price = request.form.get("price")
+    error = None
+
+    # Check a symbol was submitted
+    if not symbol:
+        error = "yeah, if you could provide a symbol"
+
+    # Check shares is a positive integer
+    elif not re.fullmatch(r"[1-9]+[0-9]*", shares or ""):
+        error = ("yeah, if you could provide a positive whole number of "
+                 "shares")
+
+    # Check the order is a buy or sell limit or stop
+    elif side not in SIDES or kind not in KINDS:
+        error = "yeah, if you could choose a type of order"
+
+    # Check the trigger price is a positive amount
+    elif not re.fullmatch(r"\s*\$?\d*\.?\d+\s*", price or "") or \
+            not Decimal(price.strip().lstrip("$")):
+        error = "yeah, if you could enter a valid price"
+
+    # Check user owns enough shares for a sell order
+    elif side == "SELL" and not Portfolio.query.join(Stock).filter(
+            Portfolio.user_id == session["user_id"],
+            Stock.symbol == symbol.upper(),
+            Portfolio.quantity >= int(shares)).first():
+        error = f"yeah, if you owned enough {symbol} shares"
+
+    # Check the symbol is listed before looking it up
+    elif unlisted(symbol):
+        error = f"yeah, if {symbol} could be a listed symbol"
+
+    else:
+        # Lookup a quote for symbol
+        quoted = quote_lookup(symbol)
+
+        # Failed lookup
+        if quoted is None:
+            error = f"yeah, if we could find a quote for {symbol}"
+
+    # Handle all errors thus far
+    if error:
+        flash("403 Forbidden")
+        return apology(error, 403)
+
+    # Store the order
+    order = Order(user_id=session["user_id"], symbol=quoted["symbol"],
+                  name=quoted["name"], side=side, kind=kind,
+                  price=str(Decimal(price.strip().lstrip("$"))),
+                  quantity=int(shares), datetime=datetime.now())
     try:
+        db.session.add(order)
         db.session.commit()
     except exc.SQLAlchemyError:
         db.session.rollback()
         flash("500 Internal Server Error")
         return apology("yeah, if the server could work properly", 500)
 
-    # Redirect user to home page
-    flash("Sale complete")
-    return redirect("/")
+    # Rest it in the order book, and list the stock for autocomplete as
+    # buy() does, as filling the order may add it to the stocks table
+    current_app.extensions["order_engine"].add(order)
+    current_app.extensions["symbols"].add(order.symbol, order.name)
+
+    flash("Order placed")
+    return redirect("/orders")
+
+
+@bp.route("/cancel_order", methods=["POST"])
+@login_required
+def cancel_order():
+    """Cancel one of the user's open orders"""
+
+    # Lock the order so the order engine cannot fill it meanwhile
+    order = Order.query.filter_by(id=request.form.get("order_id"),
+                                  user_id=session["user_id"],
+                                  status="OPEN").with_for_update().first()
+    if not order:
+        flash("403 Forbidden")
+        return apology("yeah, if you could pick one of your open orders", 403)
+
+    order.status = "CANCELLED"
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        flash("500 Internal Server Error")
+        return apology("yeah, if the server could work properly", 500)
+
+    current_app.extensions["order_engine"].cancel(order)
+
+    flash("Order cancelled")
+    return redirect("/orders")
+
+
+@bp.route("/statements", methods=["GET", "POST"])
+@login_required
+def statements():
+    """Request monthly statements and exports and list them"""
+
+    # Start this process's job workers, if not yet running, so they pick up
+    # the jobs queued here and any left over from before a restart
+    jobs = current_app.extensions["jobs"]
+    jobs.start()
+
+    # User reached route via GET (as by clicking a link or via redirect)
+    if request.method == "GET":
+        return render_template("statements.html",
+                               jobs=jobs.jobs(session["user_id"]))
+
+    # User reached route via POST (as by submitting a form via POST)
+    month = request.form.get("month")
+
+    # Check a month was chosen, unless this is an export
+    if request.form.get("export"):
+        job_id = jobs.submit("export", user_id=session["user_id"])
+    elif not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", month or ""):
+        flash("403 Forbidden")
+        return apology("yeah, if you could choose a month", 403)
+    else:
+        job_id = jobs.submit("statement", user_id=session["user_id"],
+                             month=month)
+
+    flash(f"Job {job_id} queued")
+    return redirect("/statements")
+
+
+@bp.route("/jobs/<int:job_id>")
+@login_required
+def job_status(job_id):
+    """Return the status of one of the user's jobs as JSON"""
+
+    job = user_job(job_id)
+    return jsonify({"id": job["id"], "kind": job["kind"],
+                    "status": job["status"], "attempts": job["attempts"]})
+
+
+@bp.route("/statement/<int:job_id>")
+@login_required
+def statement(job_id):
+    """Show a generated monthly statement"""
+
+    job = user_job(job_id, "statement")
+    return render_template("statement.html", statement=job["result"])
+
+
+@bp.route("/exports/<int:job_id>")
+@login_required
+def export(job_id):
+    """Download a built transactions export"""
+
+    job = user_job(job_id, "export")
+    return send_from_directory(current_app.config["EXPORTS_DIR"],
+                               job["result"]["file"], as_attachment=True,
+                               download_name="transactions.csv")
+
+
+def user_job(job_id, kind=None):
+    """Return one of the user's jobs, finished if of kind, or abort 404."""
+    from jobs import DONE
+
+    job = current_app.extensions["jobs"].get(job_id)
+    if job is None or job["user_id"] != session["user_id"] or \
+            kind and (job["kind"] != kind or job["status"] != DONE):
+        abort(404)
+    return job
+
+
+def reconcile_job():
+    """Reconcile the ledger as a background job"""
+    return {"problems": reconcile()}
 
 
-@app.route("/deposit", methods=["GET", "POST"])
+def execute_order(order, price):
+    """Execute a triggered order, returning an error message on failure"""
+
+    # Query for the user, locking the row where the database supports it
+    user = User.query.filter_by(id=order.user_id).with_for_update().first()
+
+    if order.side == "BUY":
+        # Check user can afford purchase
+        if Decimal(user.cash) < Decimal(order.quantity) * Decimal(str(price)):
+            return "not enough cash"
+        buy_shares(user, order.symbol, order.name, order.quantity, price)
+
+    else:
+        # Check user still owns enough shares to sell
+        portfolio = Portfolio.query.join(Stock).filter(
+            Portfolio.user_id == user.id, Stock.symbol == order.symbol).\
+            with_for_update().first()
+        if not portfolio or portfolio.quantity < order.quantity:
+            return "not enough shares"
+        sell_shares(user, portfolio, order.quantity, price)
+
+    return None
+
+
+@bp.route("/deposit", methods=["GET", "POST"])
 @login_required
+@idempotent
 def deposit():
     """Allow user to deposit more cash"""
 
     return cash_transaction(True)
 
 
-@app.route("/withdraw", methods=["GET", "POST"])
+@bp.route("/withdraw", methods=["GET", "POST"])
 @login_required
+@idempotent
 def withdraw():
     """Allow user to withdraw cash"""
 
@@ -625,8 +1190,12 @@ def withdraw():
 def cash_transaction(is_deposit):
     """Implement both the deposit and withdrawal routes"""
 
-    # Query for the user
-    user = User.query.filter_by(id=session["user_id"]).first()
+    # Query for the user, locking the row for a transaction where the
+    # database supports it
+    user = User.query.filter_by(id=session["user_id"])
+    if request.method == "POST":
+        user = user.with_for_update()
+    user = user.first()
 
     # User reached route via GET (as by clicking a link or via redirect)
     if request.method == "GET":
@@ -706,12 +1275,15 @@ def cash_transaction(is_deposit):
         user.cash = str(Decimal(user.cash) - amount)
 
     # Create the row for the transactions table
-    cash_type = TransactionType.query.filter_by(name="CASH").first()
-    db.session.add(Transaction(user_id=user.id, stock_id=stock.id,
-                               type_id=cash_type.id, quantity=0,
-                               price=str(amount), datetime=datetime.now()))
-
-    # Try to commit changes
+    transaction = Transaction(user_id=user.id, stock_id=stock.id,
+                              type_id=transaction_type_id("CASH"), quantity=0,
+                              price=str(amount), datetime=datetime.now())
+    db.session.add(transaction)
+    post_cash(transaction, amount if is_deposit else -amount)
+
+    # Try to commit changes, along with the response repeats of this
+    # submission get
+    response = record(redirect("/"))
     try:
         db.session.commit()
     except exc.SQLAlchemyError:
@@ -724,10 +1296,10 @@ def cash_transaction(is_deposit):
         flash("Deposit complete")
     else:
         flash("Withdrawal complete")
-    return redirect("/")
+    return response
 
 
-@app.route("/account")
+@bp.route("/account")
 @login_required
 def account():
     """Allow user to make account changes"""
@@ -735,7 +1307,7 @@ def account():
     return render_template("account.html")
 
 
-@app.route("/change_password", methods=["POST"])
+@bp.route("/change_password", methods=["POST"])
 @login_required
 def change_password():
     """Change the user's password"""
@@ -794,7 +1366,7 @@ def change_password():
     return redirect("/")
 
 
-@app.route("/delete_user", methods=["POST"])
+@bp.route("/delete_user", methods=["POST"])
 @login_required
 def delete_user():
     """Delete the user's account"""
@@ -824,15 +1396,14 @@ def delete_user():
         flash("403 Forbidden")
         return apology(error, 403)
 
-    # Delete user from users table, deletion cascades to portfolio and
-    # transactions
-    db.session.delete(user)
+    # Delete user's ledger, transactions and portfolio then the user, using
+    # bulk statements rather than loading every child row
+    user_id = user.id
+    delete_user_rows(user_id)
 
     # Delete any stocks which are no longer referenced in any user's
     # transactions
-    for stock in Stock.query.all():
-        if not stock.transactions:
-            db.session.delete(stock)
+    delete_orphan_stocks()
 
     # Commit change
     try:
@@ -842,6 +1413,18 @@ def delete_user():
         flash("500 Internal Server Error")
         return apology("yeah, if the server could work properly", 500)
 
+    # Only once the account is gone, drop it from the caches and forget
+    # its jobs, deleting any exports they built
+    current_app.extensions["equity"].forget(user_id)
+    current_app.extensions["leaderboard"].remove(user_id)
+    from jobs import DONE
+    for job in current_app.extensions["jobs"].forget(user_id):
+        if job["kind"] == "export" and job["status"] == DONE:
+            path = os.path.join(current_app.config["EXPORTS_DIR"],
+                                job["result"]["file"])
+            if os.path.exists(path):
+                os.remove(path)
+
     # Forget any user_id
     session.clear()
 
@@ -854,8 +1437,3 @@ def errorhandler(e):
     """Handle error"""
     flash(e.code)
     return apology(f"yeah, if we could not have {e.name} errors", e.code)
-
-
-# listen for errors
-for code in default_exceptions:
-    app.errorhandler(code)(errorhandler)
@@ -0,0 +1,35 @@
+"""Shared setup for the benchmarks: an app on a throwaway database."""
+
+import os
+import sys
+import tempfile
+
+# The benchmarks are run as scripts from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application import create_app  # noqa: E402
+from migrations import upgrade  # noqa: E402
+from models import bootstrap, db  # noqa: E402
+
+
+def temp_app(**config):
+    """Return an app with initialised tables in a new temporary directory."""
+
+    root = tempfile.mkdtemp(prefix="finance-bench-")
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI":
+            "sqlite:///" + os.path.join(root, "finance.db"),
+        "SQLALCHEMY_ECHO": False,
+        "SHARED_STORE": os.path.join(root, "shared.db"),
+        "JOBS_DB": os.path.join(root, "jobs.db"),
+        "JOBS_WORKERS": 0,
+        "BARS_DIR": os.path.join(root, "bars"),
+        "EXPORTS_DIR": os.path.join(root, "exports"),
+        "ORDER_ENGINE_LOCK": None,
+        **config,
+    })
+    with app.app_context():
+        bootstrap()
+        upgrade()
+    app.root = root
+    return app
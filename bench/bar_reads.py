@@ -0,0 +1,50 @@
+"""Read latency of the price history store over years of minute bars.
+
+    python bench/bar_reads.py [years]
+
+Minute bars for 390 minutes a trading day and 252 days a year are appended
+for one symbol, then ranges of an hour to the whole history are read and
+downsampled to a chart's 500 points.
+"""
+
+import random
+import sys
+import time
+
+from _setup import temp_app
+
+MINUTES = 252 * 390
+SPANS = (("hour", 60), ("day", 390), ("month", 21 * 390),
+         ("year", MINUTES))
+POINTS = 500
+REPEATS = 20
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    store = temp_app().extensions["bars"]
+    random.seed(0)
+    first = 1_500_000_000
+    price = 100.0
+    bars = []
+    for i in range(years * MINUTES):
+        price += random.uniform(-0.1, 0.1)
+        bars.append((first + 60 * i, price, price + 0.05, price - 0.05,
+                     price, 100))
+    start = time.perf_counter()
+    store.append("AAPL", bars)
+    print(f"appended {len(bars)} bars in "
+          f"{time.perf_counter() - start:.1f} s")
+
+    for label, minutes in SPANS + (("all", years * MINUTES),):
+        end = first + 60 * (minutes - 1)
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            found = store.range("AAPL", first, end) if minutes <= POINTS \
+                else store.downsample("AAPL", first, end, POINTS)
+        elapsed = (time.perf_counter() - start) / REPEATS
+        print(f"{label}: {elapsed * 1000:.2f} ms for {len(found)} points")
+
+
+if __name__ == "__main__":
+    main()
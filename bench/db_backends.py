@@ -0,0 +1,87 @@
+"""Latency of the trade and read routes on the configured database backend.
+
+    DATABASE_URL=postgresql://... python bench/db_backends.py [requests]
+
+The database is configured from DATABASE_URL, and DATABASE_REPLICA_URL if
+set, as database.py configures the app, or is a throwaway SQLite file when
+DATABASE_URL is unset. Point it at a scratch database, as tables are created
+in it and users registered. Buys, then portfolio and history pages, are
+timed in turn, with quotes from the simulated market. A replica is kept up
+to date by the database itself, except that a SQLite replica is copied from
+the primary after the buys.
+"""
+
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import time
+import uuid
+
+os.environ.setdefault("QUOTE_PROVIDER", "simulated")
+
+from _setup import temp_app  # noqa: E402
+from database import REPLICA, database_config  # noqa: E402
+from models import db  # noqa: E402
+
+ROUTES = (("buy", "post", "/buy", {"symbol": "AAPL", "shares": "1"}),
+          ("index", "get", "/", None),
+          ("history", "get", "/history", None))
+
+
+def replicate(app):
+    """Copy a SQLite primary to a SQLite replica, as replication would."""
+
+    with app.app_context():
+        replica = db.engines.get(REPLICA)
+        if replica is None or replica.dialect.name != "sqlite":
+            return
+        source = sqlite3.connect(db.engine.url.database)
+        target = sqlite3.connect(replica.url.database)
+        source.backup(target)
+        source.close()
+        target.close()
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    config = {}
+    if "DATABASE_URL" in os.environ:
+        config = database_config()
+    config["SQLALCHEMY_ECHO"] = False
+    app = temp_app(**config)
+    with app.app_context():
+        print(f"primary {db.engine.url!r}")
+        for bind, uri in app.config["SQLALCHEMY_BINDS"].items():
+            print(f"{bind} {uri}")
+
+    client = app.test_client()
+    password = "Bench-1" + uuid.uuid4().hex[:8]
+    response = client.post("/register", data={
+        "username": uuid.uuid4().hex, "password": password,
+        "confirmation": password})
+    assert response.status_code == 302, response.status_code
+    client.post("/deposit", data={"amount": str(requests * 1000),
+                                  "password": password})
+
+    for name, method, path, data in ROUTES:
+        if name == "index":
+            replicate(app)
+        expected = 302 if method == "post" else 200
+        times = []
+        for _ in range(requests):
+            # Leaving out what the routes print
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                response = getattr(client, method)(path, data=data)
+                times.append(time.perf_counter() - start)
+            assert response.status_code == expected, response.status_code
+        times.sort()
+        print(f"{name}: mean {sum(times) / len(times) * 1000:.2f} ms, "
+              f"p95 {times[int(len(times) * 0.95)] * 1000:.2f} ms, "
+              f"{len(times) / sum(times):.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
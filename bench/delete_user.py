@@ -0,0 +1,45 @@
+"""Time deleting an account among 100k stocks and transactions.
+
+    python bench/delete_user.py [stocks]
+
+Two users each hold half of the stocks, one transaction per stock. Deleting
+one user removes their rows and the stocks only they traded.
+"""
+
+import sys
+import time
+from datetime import datetime
+
+from _setup import temp_app
+from models import (db, delete_orphan_stocks, delete_user_rows, Stock,
+                    Transaction, transaction_type_id, User)
+
+
+def main():
+    stocks = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    app = temp_app()
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {"id": 1, "username": "a", "hash": "x", "cash": "0"},
+            {"id": 2, "username": "b", "hash": "x", "cash": "0"}])
+        db.session.execute(Stock.__table__.insert(), [
+            {"id": i, "symbol": f"S{i}", "name": f"Stock {i}"}
+            for i in range(1, stocks + 1)])
+        now = datetime.now()
+        db.session.execute(Transaction.__table__.insert(), [
+            {"user_id": 1 + i % 2, "stock_id": i,
+             "type_id": transaction_type_id("BUY"), "quantity": 1,
+             "price": "1", "datetime": now} for i in range(1, stocks + 1)])
+        db.session.commit()
+
+        start = time.perf_counter()
+        delete_user_rows(1)
+        delete_orphan_stocks()
+        db.session.commit()
+        elapsed = time.perf_counter() - start
+        print(f"deleted a user among {stocks} stocks and transactions in "
+              f"{elapsed * 1000:.0f} ms, {Stock.query.count()} stocks left")
+
+
+if __name__ == "__main__":
+    main()
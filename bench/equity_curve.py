@@ -0,0 +1,62 @@
+"""Time the equity curve of a 10-year, 50k-trade account.
+
+    python bench/equity_curve.py [trades]
+
+Daily bars for 50 symbols are stored for 10 years and the trades spread
+evenly over them. The curve is timed cold, cached and a few days later.
+"""
+
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from _setup import temp_app
+from models import db, Stock, Transaction, transaction_type_id, User
+
+SYMBOLS = [f"S{i}" for i in range(50)]
+DAYS = 3650
+FIRST = datetime(2016, 1, 4)
+
+
+def main():
+    trades = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    app = temp_app()
+    random.seed(2)
+    for symbol in SYMBOLS:
+        price = 50.0
+        bars = []
+        for day in range(DAYS):
+            price *= 1 + random.uniform(-0.02, 0.02)
+            close = FIRST + timedelta(days=day, hours=16)
+            bars.append((int(close.timestamp()), price, price, price, price,
+                         1000))
+        app.extensions["bars"].append(symbol, bars)
+
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {"id": 1, "username": "a", "hash": "x", "cash": "0"}])
+        db.session.execute(Stock.__table__.insert(), [
+            {"id": i, "symbol": symbol, "name": symbol}
+            for i, symbol in enumerate(SYMBOLS, 1)])
+        buy, sell = transaction_type_id("BUY"), transaction_type_id("SELL")
+        db.session.execute(Transaction.__table__.insert(), [
+            {"user_id": 1, "stock_id": random.randint(1, len(SYMBOLS)),
+             "type_id": sell if i % 3 == 0 else buy,
+             "quantity": random.randint(1, 5), "price": "50",
+             "datetime": FIRST + timedelta(seconds=i * DAYS * 86400 // trades)}
+            for i in range(trades)])
+        db.session.commit()
+
+        curves = app.extensions["equity"]
+        today = FIRST.date() + timedelta(days=DAYS)
+        for label, day in (("cold", today), ("cached", today),
+                           ("3 days later", today + timedelta(days=3))):
+            start = time.perf_counter()
+            curve = curves.curve(1, day)
+            print(f"{label}: {(time.perf_counter() - start) * 1000:.0f} ms "
+                  f"for {len(curve)} days")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Latency of leaderboard queries and updates with 1M users.
+
+    python bench/leaderboard_ranking.py [users]
+
+Each user holds 3 of 100 stocks. The holdings are put in place directly,
+as load() would read them, then queries, trades and a price change are
+timed.
+"""
+
+import random
+import resource
+import sys
+import time
+
+import _setup  # noqa: F401
+from leaderboard import Leaderboard, SortedSet
+
+STOCKS = 100
+
+
+def timed(label, call, repeats):
+    """Print the mean time of call(i) over repeats."""
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        call(i)
+    print(f"{label}: {(time.perf_counter() - start) / repeats * 1e6:.1f} us")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    random.seed(1)
+    board = Leaderboard()
+    board.refresh = lambda: None
+    board.stocks = {f"S{i}": i for i in range(STOCKS)}
+    board.prices = {i: random.uniform(10, 500) for i in range(STOCKS)}
+    for user_id in range(1, users + 1):
+        board.cash[user_id] = random.uniform(0, 20000)
+        for stock_id in random.sample(range(STOCKS), 3):
+            quantity = random.randint(1, 100)
+            board.holdings[user_id][stock_id] = quantity
+            board.holders[stock_id][user_id] = quantity
+
+    start = time.perf_counter()
+    for user_id in board.cash:
+        board.totals[user_id] = board._total(user_id)
+    board.ranking = SortedSet((-total, user_id)
+                              for user_id, total in board.totals.items())
+    board.loaded = True
+    elapsed = time.perf_counter() - start
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    print(f"ranked {users} users in {elapsed:.1f} s, "
+          f"peak memory {memory} MB")
+
+    timed("top(20)", lambda i: board.top(20), 10_000)
+    timed("rank", lambda i: board.rank(random.randint(1, users)), 100_000)
+
+    def trade(i):
+        user_id = random.randint(1, users)
+        board.apply([
+            (board.entry + 1, user_id, "cash", None, "-100", 0),
+            (board.entry + 2, user_id, "holdings", 5, "100", 1)])
+    timed("trade", trade, 100_000)
+
+    holders = len(board.holders[7])
+    start = time.perf_counter()
+    board.price("S7", board.prices[7] * 1.01)
+    elapsed = time.perf_counter() - start
+    print(f"price change re-ranking {holders} holders: "
+          f"{elapsed * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Time the nightly reconciliation over millions of ledger entries.
+
+    python bench/ledger_reconcile.py [users] [trades]
+
+Each user opens with the usual cash then buys a share of one stock trades
+times, two ledger entries each, so the defaults make 2 million entries.
+The first reconciliation reads them all and checkpoints every user, the
+second reads only a day's entries: a deposit by one user in a hundred.
+"""
+
+import sys
+import time
+from datetime import datetime
+
+from _setup import temp_app
+from ledger import OPENING_CASH, reconcile
+from models import db, LedgerEntry, Portfolio, Stock, User
+
+# Users inserted at a time
+CHUNK = 1000
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    trades = int(sys.argv[2]) if len(sys.argv) > 2 else 99
+    app = temp_app()
+    now = datetime.now()
+    with app.app_context():
+        db.session.execute(Stock.__table__.insert(),
+                           [{"id": 1, "symbol": "BNCH", "name": "Bench"}])
+        for first in range(1, users + 1, CHUNK):
+            ids = range(first, min(first + CHUNK, users + 1))
+            db.session.execute(User.__table__.insert(), [
+                {"id": i, "username": f"user{i}", "hash": "x",
+                 "cash": str(OPENING_CASH - trades)} for i in ids])
+            db.session.execute(Portfolio.__table__.insert(), [
+                {"user_id": i, "stock_id": 1, "quantity": trades}
+                for i in ids])
+            entries = []
+            for i in ids:
+                entries.append({"user_id": i, "account": "cash",
+                                "stock_id": None, "amount": str(OPENING_CASH),
+                                "shares": 0, "datetime": now})
+                entries.append({"user_id": i, "account": "external",
+                                "stock_id": None,
+                                "amount": str(-OPENING_CASH), "shares": 0,
+                                "datetime": now})
+                for _ in range(trades):
+                    entries.append({"user_id": i, "account": "cash",
+                                    "stock_id": None, "amount": "-1",
+                                    "shares": 0, "datetime": now})
+                    entries.append({"user_id": i, "account": "holdings",
+                                    "stock_id": 1, "amount": "1",
+                                    "shares": 1, "datetime": now})
+            db.session.execute(LedgerEntry.__table__.insert(), entries)
+        db.session.commit()
+        print(f"{LedgerEntry.query.count()} entries for {users} users")
+
+        start = time.perf_counter()
+        problems = reconcile()
+        print(f"first reconciliation: {time.perf_counter() - start:.2f} s, "
+              f"{len(problems)} problems")
+
+        # A day's deposits by one user in a hundred
+        depositors = range(1, users + 1, 100)
+        for i in depositors:
+            user = db.session.get(User, i)
+            user.cash = str(OPENING_CASH - trades + 1)
+        db.session.execute(LedgerEntry.__table__.insert(), [
+            {"user_id": i, "account": account, "amount": amount,
+             "shares": 0, "datetime": now} for i in depositors
+            for account, amount in (("cash", "1"), ("external", "-1"))])
+        db.session.commit()
+
+        start = time.perf_counter()
+        problems = reconcile()
+        print(f"nightly reconciliation after {len(depositors)} deposits: "
+              f"{time.perf_counter() - start:.2f} s, {len(problems)} "
+              f"problems")
+
+
+if __name__ == "__main__":
+    main()
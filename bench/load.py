@@ -0,0 +1,125 @@
+"""Throughput of the app served by Gunicorn with 1 to N worker processes.
+
+    python bench/load.py --workers 1 2 4 --clients 8 --seconds 10
+
+For each worker count Gunicorn is started with gunicorn.conf.py on a
+throwaway database and the simulated market. A user is registered, then
+keep-alive clients request the given paths in turn for the given time, and
+the requests per second and latency percentiles are reported.
+"""
+
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import threading
+import time
+import urllib.parse
+
+from _setup import temp_app
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(root, workers, port):
+    """Start Gunicorn in root and return its process once it accepts."""
+
+    env = dict(os.environ, DATABASE_URL="sqlite:///"
+               + os.path.join(root, "finance.db"), DATABASE_ECHO="0",
+               QUOTE_PROVIDER="simulated", BIND=f"127.0.0.1:{port}",
+               WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen(
+        ["gunicorn", "-c", os.path.join(REPOSITORY, "gunicorn.conf.py"),
+         "--pythonpath", REPOSITORY], cwd=root, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit("gunicorn did not start")
+
+
+def register(port):
+    """Register a new user and return their session cookie."""
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    password = "Benchmark1"
+    conn.request("POST", "/register", urllib.parse.urlencode({
+        "username": f"load{time.time_ns()}", "password": password,
+        "confirmation": password}),
+        {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    return response.getheader("Set-Cookie").split(";")[0]
+
+
+def client(port, cookie, paths, deadline, latencies, errors):
+    """Request paths in turn over one connection until deadline."""
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    i = 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request("GET", paths[i % len(paths)],
+                         headers={"Cookie": cookie})
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors.append(1)
+            conn.close()
+            continue
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(response.status)
+        i += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--paths", nargs="+",
+                        default=["/", "/history", "/quote"])
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients requesting "
+          f"{' '.join(args.paths)} for {args.seconds:g} s")
+    for workers in args.workers:
+        root = temp_app().root
+        server = serve(root, workers, args.port)
+        try:
+            cookie = register(args.port)
+            latencies = []
+            errors = []
+            deadline = time.monotonic() + args.seconds
+            threads = [threading.Thread(
+                target=client, args=(args.port, cookie, args.paths, deadline,
+                                     latencies, errors))
+                for _ in range(args.clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies.sort()
+        print(f"{workers} workers: {len(latencies) / args.seconds:.0f} "
+              f"req/s, median "
+              f"{statistics.median(latencies) * 1000:.1f} ms, p99 "
+              f"{latencies[len(latencies) * 99 // 100] * 1000:.1f} ms, "
+              f"{len(errors)} errors")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Quote throughput of the simulated market, directly and through the cache.
+
+    python bench/market_quotes.py [quotes]
+
+Quotes are for symbols drawn at random from the 5000 simulated ones. The
+market is called directly with its clock stopped, then with a tick between
+every quote so that each moves all the prices, then through a QuoteCache on
+the app's shared store, first missing and then hitting it. The target is
+100k quotes/s from the market itself.
+"""
+
+import itertools
+import random
+import sys
+import time
+
+from _setup import temp_app
+from market import SimulatedMarket
+from shared import QuoteCache
+
+TARGET = 100_000
+
+
+def rate(quote, symbols):
+    """Return the quotes per second of quote over symbols."""
+
+    start = time.perf_counter()
+    for symbol in symbols:
+        quote(symbol)
+    return len(symbols) / (time.perf_counter() - start)
+
+
+def main():
+    quotes = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    app = temp_app()
+    listing = app.config["SYMBOL_LISTING"]
+    market = SimulatedMarket(listing, seed=0, clock=lambda: 0)
+    random.seed(0)
+    symbols = random.choices(list(market.names), k=quotes)
+
+    direct = rate(market, symbols)
+    print(f"market: {direct:,.0f} quotes/s, target {TARGET:,}")
+
+    clock = itertools.count()
+    ticking = SimulatedMarket(listing, seed=0, clock=lambda: next(clock))
+    print(f"market, a tick per quote: "
+          f"{rate(ticking, symbols[:1000]):,.0f} quotes/s")
+
+    cache = QuoteCache(app.extensions["shared"], market)
+    distinct = list(dict.fromkeys(symbols))
+    print(f"cache misses: {rate(cache, distinct):,.0f} quotes/s")
+    print(f"cache hits: {rate(cache, symbols):,.0f} quotes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Throughput of trigger evaluation with 1M resting orders.
+
+    python bench/order_triggers.py [orders]
+
+Limit orders are spread over 1000 symbols with trigger prices between 50
+and 150, and quotes around 100 then arrive for each symbol in turn.
+"""
+
+import random
+import sys
+import time
+
+import _setup  # noqa: F401
+from orders import OrderBook
+
+SYMBOLS = [f"S{i}" for i in range(1000)]
+QUOTES = 200_000
+
+
+def main():
+    orders = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    random.seed(1)
+    book = OrderBook()
+
+    start = time.perf_counter()
+    for order_id in range(orders):
+        book.add(order_id, SYMBOLS[order_id % len(SYMBOLS)],
+                 "BUY" if order_id % 2 else "SELL", "LIMIT",
+                 random.uniform(50, 150))
+    print(f"rested {len(book)} orders in "
+          f"{time.perf_counter() - start:.1f} s")
+
+    triggered = 0
+    start = time.perf_counter()
+    for i in range(QUOTES):
+        triggered += len(book.crossed(SYMBOLS[i % len(SYMBOLS)],
+                                      100 + random.uniform(-0.5, 0.5)))
+    elapsed = time.perf_counter() - start
+    print(f"{QUOTES / elapsed:,.0f} quotes per second, "
+          f"{triggered} orders triggered, {len(book)} resting")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Memory use and fan-out latency of /stream with thousands of clients.
+
+Serve the app with the simulated market, for instance
+
+    QUOTE_PROVIDER=simulated BIND=127.0.0.1:8000 WEB_CONCURRENCY=1 gunicorn
+
+then run
+
+    python bench/stream_clients.py --clients 5000 --pid <worker pid>
+
+A new user buys one share and the given number of clients watch their
+portfolio. For each price change the time from the first client receiving it
+to the last is reported, with the worker's memory and the latency of other
+requests while the streams are open. Raise the open file limit of both
+processes (ulimit -n) above the number of clients first.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import http.client
+import json
+import re
+import socket
+import statistics
+import time
+import urllib.parse
+
+import gevent
+
+
+def request(args, method, path, data=None, cookie=None):
+    """Make a request and return the response and its body."""
+
+    conn = http.client.HTTPConnection(args.host, args.port, timeout=30)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    if cookie:
+        headers["Cookie"] = cookie
+    conn.request(method, path, data and urllib.parse.urlencode(data), headers)
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def rss(pid):
+    """Return the resident memory of process pid in MB."""
+
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+def stream(args, cookie, opened, arrivals):
+    """Watch the portfolio, recording when each price arrives."""
+
+    sock = socket.create_connection((args.host, args.port))
+    sock.sendall(f"GET /stream HTTP/1.1\r\nHost: {args.host}\r\n"
+                 f"Cookie: {cookie}\r\n\r\n".encode())
+    buffer = sock.recv(65536)
+    opened[sock] = buffer.startswith(b"HTTP/1.1 200")
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        now = time.perf_counter()
+        buffer += data
+        *events, buffer = buffer.split(b"\n\n")
+        for event in events:
+            match = re.search(rb"^data: (.*)$", event, re.MULTILINE)
+            if match:
+                price = json.loads(match.group(1))["price"]
+                arrivals.setdefault(price, []).append(now)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--changes", type=int, default=3,
+                        help="price changes to wait for")
+    parser.add_argument("--symbol", default="AAPL")
+    parser.add_argument("--pid", type=int,
+                        help="worker process to report the memory of")
+    args = parser.parse_args()
+
+    password = "Benchmark1"
+    response, _ = request(args, "POST", "/register", {
+        "username": f"bench{time.time_ns()}", "password": password,
+        "confirmation": password})
+    cookie = response.getheader("Set-Cookie").split(";")[0]
+    _, page = request(args, "GET", "/buy", cookie=cookie)
+    key = re.search(rb'name="idempotency_key" value="(\w+)"', page).group(1)
+    response, _ = request(args, "POST", "/buy", {
+        "symbol": args.symbol, "shares": 1,
+        "idempotency_key": key.decode()}, cookie)
+    if response.status != 302:
+        raise SystemExit(f"buying {args.symbol} failed: {response.status}")
+    if args.pid:
+        idle = rss(args.pid)
+
+    opened = {}
+    arrivals = {}
+    start = time.perf_counter()
+    for i in range(args.clients):
+        gevent.spawn(stream, args, cookie, opened, arrivals)
+        if i % 200 == 0:
+            gevent.sleep(0.05)
+    while len(opened) < args.clients and time.perf_counter() - start < 120:
+        gevent.sleep(0.5)
+    print(f"{sum(opened.values())} of {args.clients} streams open "
+          f"in {time.perf_counter() - start:.1f} s")
+    if args.pid:
+        print(f"worker memory {rss(args.pid):.0f} MB, {idle:.0f} MB before")
+
+    latencies = []
+    for _ in range(20):
+        start = time.perf_counter()
+        request(args, "GET", "/history", cookie=cookie)
+        latencies.append(time.perf_counter() - start)
+    print(f"/history with the streams open: median "
+          f"{statistics.median(latencies) * 1000:.1f} ms, "
+          f"max {max(latencies) * 1000:.1f} ms")
+
+    # The price sent on connecting is not a change, later ones are
+    initial = set(arrivals)
+    changes = []
+    deadline = time.perf_counter() + 60 * args.changes
+    while len(changes) < args.changes and time.perf_counter() < deadline:
+        gevent.sleep(1)
+        changes = [price for price, times in arrivals.items()
+                   if price not in initial and len(times) >= len(opened)]
+    for price in changes:
+        times = arrivals[price]
+        print(f"{args.symbol} at {price}: {len(times)} clients, "
+              f"last {(max(times) - min(times)) * 1000:.0f} ms after first")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Latency of symbol lookups and searches over 100k listed symbols.
+
+    python bench/symbol_search.py [symbols]
+
+A listing of random symbols and company names is generated, then known()
+and search() are timed for a few kinds of query.
+"""
+
+import csv
+import os
+import random
+import string
+import sys
+import time
+
+from _setup import temp_app
+from symbols import SymbolDirectory
+
+QUERIES = ("A", "AB", "XYZ", "comp", "zq", "QQQQQ")
+REPEATS = 1000
+
+
+def main():
+    symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    app = temp_app()
+    random.seed(0)
+    path = os.path.join(app.root, "listing.csv")
+    with open(path, "w", newline="") as listing:
+        writer = csv.writer(listing)
+        writer.writerow(["symbol", "name"])
+        for i in range(symbols):
+            symbol = "".join(random.choices(string.ascii_uppercase,
+                                            k=random.randint(1, 4)))
+            name = "".join(random.choices(string.ascii_lowercase, k=7))
+            writer.writerow([f"{symbol}{i}", f"{name.title()} Company Inc."])
+
+    with app.app_context():
+        directory = SymbolDirectory(path)
+        start = time.perf_counter()
+        directory.load()
+        print(f"loaded {len(directory)} symbols in "
+              f"{time.perf_counter() - start:.2f} s")
+
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            directory.known("ABC1")
+        print(f"known: {(time.perf_counter() - start) / REPEATS * 1e6:.1f} "
+              f"us")
+        for query in QUERIES:
+            start = time.perf_counter()
+            for _ in range(REPEATS):
+                found = directory.search(query)
+            elapsed = (time.perf_counter() - start) / REPEATS
+            print(f"search {query!r}: {elapsed * 1000:.3f} ms, "
+                  f"{len(found)} found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Database backend configuration for CS50 Finance.
+
+The backend is chosen by environment variables, so the same code serves a
+local SQLite file or a PostgreSQL primary with an optional read replica:
+
+    DATABASE_URL          primary database, default sqlite:///finance.db in
+                          the working directory
+    DATABASE_REPLICA_URL  read replica used by read-only routes, if set
+    DATABASE_POOL_SIZE    connections kept open per engine (not SQLite)
+    DATABASE_MAX_OVERFLOW extra connections allowed under load (not SQLite)
+    DATABASE_POOL_RECYCLE seconds before a pooled connection is replaced
+    DATABASE_ECHO         set to 0 to stop logging every statement
+"""
+
+import os
+import os.path
+from functools import wraps
+from flask import g
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Name of the bind used for the read replica
+REPLICA = "replica"
+
+
+def database_config(environ=os.environ):
+    """Return the Flask-SQLAlchemy config for the configured backend."""
+
+    db_path = os.path.join(os.getcwd(), "finance.db")
+    uri = environ.get("DATABASE_URL", "sqlite:///" + db_path)
+
+    # Heroku style URLs name the dialect "postgres"
+    if uri.startswith("postgres://"):
+        uri = "postgresql://" + uri[len("postgres://"):]
+
+    config = {
+        "SQLALCHEMY_DATABASE_URI": uri,
+        "SQLALCHEMY_ECHO": environ.get("DATABASE_ECHO", "1") != "0",
+        "SQLALCHEMY_TRACK_MODIFICATIONS": True,
+        "SQLALCHEMY_BINDS": {},
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+    }
+
+    # Pool settings only apply to client/server databases
+    if not uri.startswith("sqlite"):
+        options = config["SQLALCHEMY_ENGINE_OPTIONS"]
+        options["pool_pre_ping"] = True
+        options["pool_size"] = int(environ.get("DATABASE_POOL_SIZE", 5))
+        options["max_overflow"] = int(environ.get("DATABASE_MAX_OVERFLOW", 10))
+        options["pool_recycle"] = int(environ.get("DATABASE_POOL_RECYCLE",
+                                                  1800))
+
+    replica = environ.get("DATABASE_REPLICA_URL")
+    if replica:
+        if replica.startswith("postgres://"):
+            replica = "postgresql://" + replica[len("postgres://"):]
+        config["SQLALCHEMY_BINDS"][REPLICA] = replica
+
+    return config
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use write-ahead logging and enforce foreign keys on SQLite."""
+
+    if type(dbapi_connection).__module__.startswith("sqlite3"):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+class RoutingSession(Session):
+    """Session sending reads to the replica during read-only requests.
+
+    Anything flushed, and every query outside a read-only request, goes to
+    the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and g.get("read_only")
+                and REPLICA in self._db.engines):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def read_only(f):
+    """Decorate routes whose queries may be served by the read replica."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
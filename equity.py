@@ -0,0 +1,167 @@
+"""Daily value of a user's total assets, rebuilt from their transactions.
+
+Transactions are bucketed into per-day changes in cash and in shares of
+each stock, which are turned into running balances with accumulate, valued
+against daily closes from the price history and summed across stocks with
+map, so the per-day work runs in C rather than in Python loops.
+
+Days before today never change, so each user's curve and balances at the
+end of it are cached and later requests only replay the days since.
+"""
+
+import operator
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+from functools import partial
+from itertools import accumulate, repeat
+from sqlalchemy import Text, cast, select
+
+from ledger import OPENING_CASH
+from models import db, Stock, Transaction, TransactionType
+
+
+def day_end(day):
+    """Return the epoch time at the end of the day with ordinal day."""
+    return datetime.combine(date.fromordinal(day + 1), time()).timestamp()
+
+
+def daily_closes(store, symbol, ends, fallback):
+    """Return the closing price of symbol at each of the epoch times ends.
+
+    Days without bars carry the previous close forward, days before the
+    first bar use fallback.
+    """
+
+    views = store.columns(symbol)
+    if not views:
+        return array("d", repeat(fallback, len(ends)))
+    times, closes = views["time"], views["close"]
+
+    # Index just past each day's last bar, ascending as ends are
+    after = array("q", map(partial(bisect_right, times), ends))
+
+    # Days before the first bar take the fallback, the rest that bar's close
+    before = bisect_right(after, 0)
+    prices = array("d", repeat(fallback, before))
+    prices.extend(map(closes.__getitem__,
+                      map((-1).__add__, after[before:])))
+    return prices
+
+
+class EquityCurves:
+    """Per-user cache of daily total asset values."""
+
+    def __init__(self, store):
+        self.store = store
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def curve(self, user_id, today=None):
+        """Return [(date, total assets)] for each day the user has traded."""
+
+        today = (today or date.today()).toordinal()
+
+        with self._lock:
+            state = self._cache.get(user_id)
+        if state is None:
+            state = {"first": None, "day": None, "transaction": 0,
+                     "cash": float(OPENING_CASH), "holdings": {},
+                     "prices": {}, "values": array("d")}
+
+        # Replay the transactions since those already cached
+        rows = self._transactions(user_id, state["transaction"])
+        if not rows and state["first"] is None:
+            return []
+        if state["first"] is None:
+            state["first"] = rows[0][0]
+            state["day"] = state["first"] - 1
+
+        # Complete days are cached, today is computed afresh every time
+        past = [row for row in rows if row[0] < today]
+        if state["day"] < today - 1:
+            state = self._extend(state, past, today - 1)
+            with self._lock:
+                self._cache[user_id] = state
+        live = self._extend(state, [row for row in rows if row[0] >= today],
+                            today)
+
+        first = date.fromordinal(live["first"])
+        return [(first + timedelta(days=i), value)
+                for i, value in enumerate(live["values"])]
+
+    def forget(self, user_id):
+        """Drop a user's cached curve, as when their account is deleted."""
+
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def _transactions(self, user_id, after):
+        """Return (day, id, type, symbol, name, quantity, price) tuples."""
+
+        # Dates are read as text, much faster than building datetimes, and
+        # each day's ordinal is worked out once
+        query = select(cast(Transaction.datetime, Text), Transaction.id,
+                       TransactionType.name, Stock.symbol, Stock.name,
+                       Transaction.quantity, Transaction.price).\
+            join(TransactionType).join(Stock).\
+            where(Transaction.user_id == user_id, Transaction.id > after).\
+            order_by(Transaction.id)
+
+        # Executed on the connection, skipping the ORM for speed
+        rows = db.session.connection().execute(query).all()
+        days = {}
+        return [(days.get(when[:10]) or days.setdefault(
+                    when[:10], date.fromisoformat(when[:10]).toordinal()),
+                 *rest) for when, *rest in rows]
+
+    def _extend(self, state, rows, last):
+        """Return state with values added for each day up to last."""
+
+        start = state["day"] + 1
+        days = last - start + 1
+        if days <= 0:
+            return state
+
+        # Bucket the transactions into per-day changes
+        cash = array("d", bytes(8 * days))
+        shares = {symbol: array("q", bytes(8 * days))
+                  for symbol, held in state["holdings"].items() if held}
+        prices = dict(state["prices"])
+        transaction = state["transaction"]
+        for day, transaction, ttype, symbol, name, quantity, price in rows:
+            i = day - start
+            if ttype == "CASH":
+                amount = float(price)
+                cash[i] += -amount if name == "Withdrawal" else amount
+                continue
+            if ttype == "SELL":
+                quantity = -quantity
+            price = float(price)
+            cash[i] -= quantity * price
+            if symbol not in shares:
+                shares[symbol] = array("q", bytes(8 * days))
+            shares[symbol][i] += quantity
+
+            # The latest trade prices shares that have no bars, as in index
+            prices[symbol] = price
+
+        # Running balances, valued at each day's close
+        ends = [day_end(day) for day in range(start, last + 1)]
+        balances = array("d", accumulate(cash, initial=state["cash"]))
+        totals = balances[1:]
+        holdings = {}
+        for symbol, changes in shares.items():
+            held = array("q", accumulate(
+                changes, initial=state["holdings"].get(symbol, 0)))
+            holdings[symbol] = held[-1]
+            closes = daily_closes(self.store, symbol, ends, prices[symbol])
+            prices[symbol] = closes[-1]
+            totals = array("d", map(operator.add, totals,
+                                    map(operator.mul, held[1:], closes)))
+
+        return {"first": state["first"], "day": last,
+                "transaction": transaction, "cash": balances[-1],
+                "holdings": holdings, "prices": prices,
+                "values": state["values"] + totals}
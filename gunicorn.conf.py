@@ -0,0 +1,36 @@
+"""Gunicorn settings for serving the app in production.
+
+Run `gunicorn` from this directory to start one pre-forked worker process
+per CPU. Send the master process SIGHUP to reload gracefully: new workers
+start on the current code and the old ones finish their requests first.
+
+    BIND                address to listen on, default 127.0.0.1:8000
+    PROXY_HOPS          reverse proxies in front, default 1 when bound to
+                        127.0.0.1 and 0 otherwise
+    WEB_CONCURRENCY     worker processes, default the number of CPUs
+    WORKER_CLASS        gevent by default, or gthread for threaded workers
+    WORKER_CONNECTIONS  clients per gevent worker, default 10000
+    THREADS             threads per gthread worker, default 8
+"""
+
+import multiprocessing
+import os
+
+wsgi_app = "application:create_app()"
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+
+# Bound to localhost, a reverse proxy forwards every request, so the app
+# takes client addresses from its X-Forwarded-For header. Set in the master
+# before the workers fork, which inherit it.
+os.environ.setdefault("PROXY_HOPS",
+                      "1" if bind.startswith("127.0.0.1:") else "0")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+# Green threads, as each /stream client holds its request open while
+# connected and a greenlet is cheap enough to keep one per client
+worker_class = os.environ.get("WORKER_CLASS", "gevent")
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 10000))
+threads = int(os.environ.get("THREADS", 8))
+
+# Seconds old workers get to finish their requests on reload or shutdown
+graceful_timeout = 30
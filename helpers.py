@@ -1,8 +1,8 @@
 """Helper functions to implement application.py."""
 
-import csv
-import json
-import urllib.request
+import os
+import threading
+import time
 from functools import wraps
 from flask import redirect, render_template, session
 
@@ -40,6 +40,11 @@ def login_required(f):
 def lookup(symbol):
     """Look up quote for symbol."""
 
+    # Imported here as only quote lookups need them, keeping startup fast
+    import csv
+    import json
+    import urllib.request
+
     # Reject symbol if it starts with caret.
     if symbol.startswith("^"):
         return None
@@ -161,3 +166,62 @@ def f_time(time):
 def f_date(date):
     """Formats a datetime object as a date."""
     return date.strftime("%d %b %y")
+
+
+def cooperate():
+    """Lets other threads run, and under gevent other greenlets too.
+
+    Long loops call this every so often. Under gevent a zero sleep only
+    switches to greenlets already runnable, not to those waiting on timers
+    or sockets, so this sleeps for a tenth of a millisecond instead.
+    """
+    time.sleep(0.0001)
+
+
+def process_age():
+    """Returns the seconds since this process started, or None if unknown.
+
+    Read from /proc, so it includes the interpreter's own startup.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name in parentheses may contain spaces
+            fields = f.read().rpartition(")")[2].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except OSError:
+        return None
+    return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+class Deferred:
+    """Stands in for an object that build() returns, built on first use.
+
+    Attributes and calls are passed to the object, so a component can be
+    registered without importing its module until something uses it.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._object = None
+        self._lock = threading.Lock()
+
+    @property
+    def built(self):
+        """Whether the object has been built yet."""
+        return self._object is not None
+
+    def unwrap(self):
+        """Return the object, building it if this is its first use."""
+
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    self._object = self._build()
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self.unwrap(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.unwrap()(*args, **kwargs)
@@ -0,0 +1,148 @@
+"""Idempotency keys, so a retried trade submission runs only once.
+
+Trade forms carry a fresh key in a hidden field, and API clients may send
+one in an Idempotency-Key header. The first submission with a key claims it
+in the idempotency_keys table before the route runs, and the route records
+its response with record() in the transaction that commits the trade, so a
+trade is never committed without it. Repeats of that submission get the stored
+response without looking up quotes or touching the portfolio. Failed
+submissions release their key so the form can be corrected and resent.
+Keys expire after the app's IDEMPOTENCY_TTL.
+"""
+
+import hashlib
+import uuid
+from datetime import datetime
+from functools import wraps
+from flask import current_app, flash, g, make_response, request, session
+from sqlalchemy import exc
+
+from helpers import apology
+from models import db, IdempotencyKey
+
+# Header an API client may send the key in instead of the form field
+HEADER = "Idempotency-Key"
+
+# Form field the key is rendered into
+FIELD = "idempotency_key"
+
+
+def new_key():
+    """Return a fresh key to render into a form."""
+    return uuid.uuid4().hex
+
+
+def fingerprint():
+    """Return a hash of the submitted form, leaving out the password."""
+
+    fields = sorted((name, value) for name, value in request.form.items(True)
+                    if name not in (FIELD, "password"))
+    return hashlib.sha256(repr(fields).encode()).hexdigest()
+
+
+def claim(user_id, key, digest):
+    """Claim key for this request, or return the row of whoever has it."""
+
+    while True:
+        now = datetime.now()
+        IdempotencyKey.query.filter(IdempotencyKey.expires <= now).\
+            delete(synchronize_session=False)
+        db.session.add(IdempotencyKey(
+            user_id=user_id, key=key, path=request.path, fingerprint=digest,
+            expires=now + current_app.config["IDEMPOTENCY_TTL"]))
+        try:
+            db.session.commit()
+            return None
+        except exc.IntegrityError:
+            db.session.rollback()
+
+        # Unless it was released meanwhile, then try again
+        row = IdempotencyKey.query.filter_by(user_id=user_id,
+                                             key=key).first()
+        if row is not None:
+            return row
+
+
+def idempotent(f):
+    """Decorate POST routes so repeats of a submission return its response."""
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get(HEADER) or request.form.get(FIELD)
+        if request.method != "POST" or not key:
+            return f(*args, **kwargs)
+
+        user_id = session["user_id"]
+        digest = fingerprint()
+        claimed = claim(user_id, key, digest)
+
+        # The key is taken, answer as the first submission was answered
+        if claimed is not None:
+            if claimed.path != request.path or \
+                    claimed.fingerprint != digest:
+                flash("422 Unprocessable Entity")
+                return apology("yeah, if you could use a new key for a "
+                               "different request", 422)
+            if claimed.status is None:
+                flash("409 Conflict")
+                return apology("yeah, if you could wait for your first "
+                               "submission to finish", 409)
+            response = make_response(claimed.body, claimed.status)
+            response.mimetype = claimed.mimetype
+            if claimed.location:
+                response.headers["Location"] = claimed.location
+            return response
+
+        g.idempotency_key = (user_id, key)
+        try:
+            response = make_response(f(*args, **kwargs))
+        except BaseException:
+            db.session.rollback()
+            release(user_id, key)
+            raise
+
+        # Free the key after a failure
+        if response.status_code >= 400 or response.is_streamed:
+            release(user_id, key)
+            return response
+
+        # A route that did not record its response has it stored now
+        if not g.get("idempotency_recorded"):
+            record(response)
+            try:
+                db.session.commit()
+            except exc.SQLAlchemyError:
+                db.session.rollback()
+        return response
+    return decorated_function
+
+
+def record(response):
+    """Store response as the answer to repeats of this submission.
+
+    Routes call this before committing, so the response is stored in the
+    same transaction as their changes. Returns response.
+    """
+
+    if "idempotency_key" not in g:
+        return response
+    user_id, key = g.idempotency_key
+    row = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+    if row is not None:
+        row.status = response.status_code
+        row.location = response.headers.get("Location")
+        row.mimetype = response.mimetype
+        row.body = response.get_data()
+        g.idempotency_recorded = True
+    return response
+
+
+def release(user_id, key):
+    """Free a claimed key whose submission failed."""
+
+    IdempotencyKey.query.filter_by(user_id=user_id, key=key, status=None).\
+        delete(synchronize_session=False)
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
@@ -0,0 +1,211 @@
+"""A small job queue in a local SQLite file, for work too slow for a request.
+
+Routes submit jobs and poll their status, and a pool of worker threads in
+each process running the app claims and runs them. Claims go through the
+jobs table, so however many processes run workers:
+
+- each job runs once at a time, on one worker
+- at most the configured number of jobs of each kind run at once
+- a job whose worker died is claimed again once its lease runs out
+- a job that raises is retried after an exponential backoff, until it has
+  been attempted max_attempts times
+
+Handlers are called in an app context with the job's arguments, and the
+user_id of jobs submitted for a user, and return the job's result, anything
+JSON serialisable.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import traceback
+
+# Job statuses
+QUEUED, RUNNING, DONE, FAILED = "QUEUED", "RUNNING", "DONE", "FAILED"
+
+
+class JobQueue:
+    """Queue of jobs run by a pool of worker threads.
+
+    handlers maps each kind of job to its function and limits maps kinds to
+    the most jobs of that kind allowed to run at once, across processes.
+    """
+
+    def __init__(self, path, app, handlers, workers=2, limits=None,
+                 max_attempts=3, backoff=30, lease=3600, poll=1):
+        self.path = path
+        self.app = app
+        self.handlers = handlers
+        self.workers = workers
+        self.limits = limits or {}
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll = poll
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def _db(self):
+        """Return this thread's connection, opening it on first use."""
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, "
+                         "user_id INTEGER, args TEXT NOT NULL, "
+                         "status TEXT NOT NULL, attempts INTEGER NOT NULL, "
+                         "run_after REAL NOT NULL, lease_until REAL, "
+                         "result TEXT, error TEXT, created REAL NOT NULL, "
+                         "finished REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status "
+                         "ON jobs (status, run_after)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_user "
+                         "ON jobs (user_id)")
+            self._local.conn = conn
+        return conn
+
+    def submit(self, kind, user_id=None, **args):
+        """Queue a job and return its id."""
+
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind {kind}")
+        now = time.time()
+        job_id = self._db.execute(
+            "INSERT INTO jobs (kind, user_id, args, status, attempts, "
+            "run_after, created) VALUES (?, ?, ?, ?, 0, ?, ?)",
+            (kind, user_id, json.dumps(args), QUEUED, now, now)).lastrowid
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        """Return a job as a dict, with its result decoded, or None."""
+
+        row = self._db.execute("SELECT * FROM jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def jobs(self, user_id, limit=20):
+        """Return a user's most recent jobs, newest first."""
+
+        return [self._job(row) for row in self._db.execute(
+            "SELECT * FROM jobs WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit))]
+
+    def forget(self, user_id):
+        """Delete and return a user's jobs, as when their account goes."""
+
+        jobs = [self._job(row) for row in self._db.execute(
+            "SELECT * FROM jobs WHERE user_id = ?", (user_id,))]
+        self._db.execute("DELETE FROM jobs WHERE user_id = ?", (user_id,))
+        return jobs
+
+    @staticmethod
+    def _job(row):
+        job = dict(row)
+        job["args"] = json.loads(job["args"])
+        if job["result"] is not None:
+            job["result"] = json.loads(job["result"])
+        return job
+
+    def start(self):
+        """Start the worker threads, once."""
+
+        if self._threads or not self.workers:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def claim(self):
+        """Mark the next runnable job within its kind's limit as running.
+
+        Returns the job, or None if there is nothing to run.
+        """
+
+        conn = self._db
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            running = dict(conn.execute(
+                "SELECT kind, COUNT(*) FROM jobs WHERE status = ? "
+                "AND lease_until > ? GROUP BY kind", (RUNNING, now)))
+
+            # Queued jobs that are due, and running jobs whose worker died
+            for row in conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? AND run_after <= ? "
+                    "UNION ALL SELECT * FROM jobs WHERE status = ? "
+                    "AND lease_until <= ? ORDER BY id",
+                    (QUEUED, now, RUNNING, now)):
+                limit = self.limits.get(row["kind"])
+                if limit is not None and running.get(row["kind"], 0) >= limit:
+                    continue
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, "
+                    "lease_until = ? WHERE id = ?",
+                    (RUNNING, now + self.lease, row["id"]))
+                conn.execute("COMMIT")
+                job = self._job(row)
+                job["attempts"] += 1
+                return job
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return None
+
+    def run(self, job):
+        """Run a claimed job, recording its result or scheduling a retry."""
+
+        args = job["args"]
+        if job["user_id"] is not None:
+            args = dict(args, user_id=job["user_id"])
+        try:
+            with self.app.app_context():
+                result = self.handlers[job["kind"]](**args)
+        except Exception:
+            error = traceback.format_exc()
+            self.app.logger.warning("Job %d (%s) failed, attempt %d:\n%s",
+                                    job["id"], job["kind"], job["attempts"],
+                                    error)
+            if job["attempts"] >= self.max_attempts:
+                self._db.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished = ? "
+                    "WHERE id = ?", (FAILED, error, time.time(), job["id"]))
+            else:
+                delay = self.backoff * 2 ** (job["attempts"] - 1)
+                self._db.execute(
+                    "UPDATE jobs SET status = ?, error = ?, run_after = ? "
+                    "WHERE id = ?",
+                    (QUEUED, error, time.time() + delay, job["id"]))
+            return
+        self._db.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = NULL, "
+            "finished = ? WHERE id = ?",
+            (DONE, json.dumps(result), time.time(), job["id"]))
+
+    def _run(self):
+        """Run jobs as they become due, polling when there are none."""
+
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.OperationalError:
+                # The jobs file stayed locked by another process, try later
+                job = None
+            if job is None:
+                self._wake.wait(self.poll)
+                self._wake.clear()
+                continue
+            self.run(job)
@@ -0,0 +1,443 @@
+"""Ranking of users by total assets, kept up to date incrementally.
+
+Totals are cash plus holdings marked to the latest price, as on the
+portfolio page. Rather than recompute everyone's total, the leaderboard
+keeps each user's cash and holdings, an index from each stock to the users
+holding it, and the users ordered by total in an indexable skip list. A
+trade moves only its user, a price change only that stock's holders, and
+top-N and rank queries are O(log n).
+
+Trades reach the leaderboard through the ledger: before each query it reads
+the entries posted since the last, by any worker process. On PostgreSQL ids
+are handed out at insert, so a lower id can commit after a higher one. Ids
+skipped over are kept as gaps and read again until they turn up, or until
+GAP_TIMEOUT passes and they are taken to belong to a rolled back insert.
+
+Loading a million users takes several seconds, so the app loads the
+leaderboard in a background thread, which yields every LOAD_BATCH rows so
+that a gevent worker keeps serving meanwhile. Users are sorted in batches
+too, then merged as they are linked into the skip list.
+"""
+
+import heapq
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import func, select
+
+from helpers import cooperate
+from models import db, LedgerEntry, Portfolio, Stock, Transaction, User
+
+# Each level of the skip list links about a quarter of the nodes of the
+# level below, so this is enough for billions of users
+MAX_LEVELS = 16
+
+# Seconds a missing ledger id is waited for before it is given up on
+GAP_TIMEOUT = 60
+
+# Ids before the last at load time checked for entries yet to commit
+GAP_WINDOW = 1000
+
+# Rows read or linked between yields to other greenlets while loading
+LOAD_BATCH = 10000
+
+
+class _Node:
+    """A skip list node with its links and their widths at each level."""
+
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+class SortedSet:
+    """Indexable skip list of keys with O(log n) insert, remove and rank.
+
+    It starts with keys, sorted first unless already ordered.
+    """
+
+    def __init__(self, keys=(), ordered=False):
+        self.size = 0
+        self.levels = 1
+        self.tail = _Node((math.inf,), 0)
+        self.head = _Node(None, MAX_LEVELS)
+        self.head.next = [self.tail] * MAX_LEVELS
+
+        # Link sorted keys in one pass rather than searching for each
+        last = [self.head] * MAX_LEVELS
+        positions = [0] * MAX_LEVELS
+        for position, key in enumerate(keys if ordered else sorted(keys), 1):
+            if position % LOAD_BATCH == 0:
+                cooperate()
+            levels = self._levels()
+            node = _Node(key, levels)
+            for level in range(levels):
+                last[level].next[level] = node
+                last[level].width[level] = position - positions[level]
+                last[level] = node
+                positions[level] = position
+            self.levels = max(self.levels, levels)
+            self.size = position
+        for level in range(self.levels):
+            last[level].next[level] = self.tail
+            last[level].width[level] = self.size + 1 - positions[level]
+
+    @staticmethod
+    def _levels():
+        """Return a random number of levels for a new node."""
+        return min(MAX_LEVELS, 1 - int(math.log(1 - random.random(), 4)))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not self.tail:
+            yield node.key
+            node = node.next[0]
+
+    def add(self, key):
+        """Insert key, which must not already be present."""
+
+        # Levels above those in use link the head straight to the tail
+        levels = self._levels()
+        for level in range(self.levels, levels):
+            self.head.width[level] = self.size + 1
+        self.levels = max(self.levels, levels)
+
+        # Find the last node before key on each level, counting the steps
+        chain = [None] * self.levels
+        steps = [0] * self.levels
+        node = self.head
+        for level in reversed(range(self.levels)):
+            while node.next[level].key <= key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        # Link the new node in at its levels, lengthening the links over it
+        new = _Node(key, levels)
+        distance = 0
+        for level in range(levels):
+            before = chain[level]
+            new.next[level] = before.next[level]
+            before.next[level] = new
+            new.width[level] = before.width[level] - distance
+            before.width[level] = distance + 1
+            distance += steps[level]
+        for level in range(levels, self.levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        """Remove key, raising KeyError if it is not present."""
+
+        chain = [None] * self.levels
+        node = self.head
+        for level in reversed(range(self.levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        found = chain[0].next[0]
+        if found.key != key:
+            raise KeyError(key)
+
+        for level in range(len(found.next)):
+            before = chain[level]
+            before.width[level] += found.width[level] - 1
+            before.next[level] = found.next[level]
+        for level in range(len(found.next), self.levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def index(self, key):
+        """Return the position of key, which must be present."""
+
+        position = 0
+        node = self.head
+        for level in reversed(range(self.levels)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        if node.next[0].key != key:
+            raise KeyError(key)
+        return position
+
+
+@contextmanager
+def _snapshot():
+    """Yield a connection whose queries all see the same committed data."""
+
+    engine = db.session.get_bind()
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execution_options(isolation_level="REPEATABLE READ")
+        elif engine.dialect.name == "sqlite":
+            # pysqlite only opens a transaction itself before writes
+            conn.exec_driver_sql("BEGIN")
+        yield conn
+
+
+class Leaderboard:
+    """Users ranked by total assets, updated by trades and prices.
+
+    watch is called with the symbols users hold so their prices are polled.
+    """
+
+    def __init__(self, watch=None):
+        self.watch = watch
+        self.ranking = SortedSet()
+        self.totals = {}
+        self.cash = {}
+        self.holdings = defaultdict(dict)
+        self.holders = defaultdict(dict)
+        self.prices = {}
+        self.stocks = {}
+        self.entry = 0
+        self.gaps = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+        self._thread = None
+
+    def start(self, app):
+        """Start loading in a background thread with app's context, once."""
+
+        if self.loaded or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._load, args=(app,),
+                                            daemon=True)
+            self._thread.start()
+
+    def _load(self, app):
+        """Load in app's context, allowing another start if it fails."""
+
+        with app.app_context():
+            try:
+                self.load()
+            except Exception:
+                app.logger.exception("Leaderboard failed to load")
+                self._thread = None
+
+    def load(self):
+        """Read every user's cash and holdings and the last traded prices.
+
+        Everything is read before the lock is taken to swap it in, so trades
+        and prices are not held up meanwhile.
+        """
+
+        if self.loaded:
+            return
+        with self._loading:
+            if self.loaded:
+                return
+
+            holdings = defaultdict(dict)
+            holders = defaultdict(dict)
+            prices = {}
+            cash = {}
+            with _snapshot() as conn:
+                # Entries after this one, or missing from the snapshot, are
+                # applied by refresh()
+                entry = conn.scalar(select(func.max(LedgerEntry.id))) or 0
+                seen = set(conn.scalars(select(LedgerEntry.id).where(
+                    LedgerEntry.id > entry - GAP_WINDOW)))
+                now = time.monotonic()
+                gaps = {entry_id: now for entry_id in
+                        range(max(entry - GAP_WINDOW, 0) + 1, entry)
+                        if entry_id not in seen}
+
+                stocks = dict(conn.execute(
+                    select(Stock.symbol, Stock.id).
+                    where(Stock.symbol.isnot(None))).all())
+                latest = select(func.max(Transaction.id)).\
+                    group_by(Transaction.stock_id)
+                for stock_id, price in conn.execute(
+                        select(Transaction.stock_id, Transaction.price).
+                        where(Transaction.id.in_(latest))):
+                    prices.setdefault(stock_id, float(price))
+                for row, (user_id, stock_id, quantity) in enumerate(
+                        conn.execute(select(Portfolio.user_id,
+                                            Portfolio.stock_id,
+                                            Portfolio.quantity))):
+                    if row % LOAD_BATCH == 0:
+                        cooperate()
+                    holdings[user_id][stock_id] = quantity
+                    holders[stock_id][user_id] = quantity
+                for row, (user_id, balance) in enumerate(
+                        conn.execute(select(User.id, User.cash))):
+                    if row % LOAD_BATCH == 0:
+                        cooperate()
+                    cash[user_id] = float(balance)
+            totals = {}
+            for row, (user_id, balance) in enumerate(cash.items()):
+                if row % LOAD_BATCH == 0:
+                    cooperate()
+                totals[user_id] = balance + sum(
+                    shares * prices.get(stock_id, 0.0)
+                    for stock_id, shares in holdings.get(user_id, {}).items())
+            runs = []
+            keys = [(-total, user_id) for user_id, total in totals.items()]
+            for start in range(0, len(keys), LOAD_BATCH):
+                cooperate()
+                runs.append(sorted(keys[start:start + LOAD_BATCH]))
+            ranking = SortedSet(heapq.merge(*runs), ordered=True)
+
+            with self._lock:
+                self.entry, self.gaps = entry, gaps
+                self.stocks, self.prices = stocks, prices
+                self.holdings, self.holders = holdings, holders
+                self.cash, self.totals = cash, totals
+                self.ranking = ranking
+                self._watch(self.holders)
+                self.loaded = True
+
+    def _watch(self, stock_ids):
+        """Have the prices of stock_ids polled, the caller holding the lock."""
+
+        if self.watch is None:
+            return
+        symbols = {stock_id: symbol
+                   for symbol, stock_id in self.stocks.items()}
+        self.watch([symbols[stock_id] for stock_id in stock_ids
+                    if stock_id in symbols])
+
+    def _total(self, user_id):
+        return self.cash.get(user_id, 0.0) + sum(
+            shares * self.prices.get(stock_id, 0.0)
+            for stock_id, shares in self.holdings.get(user_id, {}).items())
+
+    def _rank(self, user_id, total=None):
+        """Move user_id to its place for its current total."""
+
+        if total is None:
+            total = self._total(user_id)
+        old = self.totals.get(user_id)
+        if old == total:
+            return
+        if old is not None:
+            self.ranking.remove((-old, user_id))
+        self.ranking.add((-total, user_id))
+        self.totals[user_id] = total
+
+    def refresh(self):
+        """Apply the cash and holdings entries posted since the last.
+
+        External entries are read too, so that their ids do not look like
+        gaps, but change nothing.
+        """
+
+        self.load()
+        with self._lock:
+            now = time.monotonic()
+            for entry_id, missed in list(self.gaps.items()):
+                if now - missed > GAP_TIMEOUT:
+                    del self.gaps[entry_id]
+            after = min(self.gaps, default=self.entry + 1) - 1
+        entries = db.session.query(
+            LedgerEntry.id, LedgerEntry.user_id, LedgerEntry.account,
+            LedgerEntry.stock_id, LedgerEntry.amount, LedgerEntry.shares).\
+            filter(LedgerEntry.id > after).\
+            order_by(LedgerEntry.id).all()
+        if not entries:
+            return
+        traded = {entry.stock_id for entry in entries} - {None}
+        with self._lock:
+            if traded - set(self.stocks.values()):
+                self.stocks.update(db.session.query(Stock.symbol, Stock.id).
+                                   filter(Stock.id.in_(traded)))
+            self.apply(entries)
+
+    def apply(self, entries):
+        """Apply ledger entries, the caller holding the lock."""
+
+        changed = set()
+        traded = set()
+        now = time.monotonic()
+        for entry_id, user_id, account, stock_id, amount, shares in entries:
+            if entry_id <= self.entry:
+                if self.gaps.pop(entry_id, None) is None:
+                    continue
+            else:
+                self.gaps.update(dict.fromkeys(
+                    range(self.entry + 1, entry_id), now))
+                self.entry = entry_id
+            if account == "cash":
+                self.cash[user_id] = (self.cash.get(user_id, 0.0)
+                                      + float(amount))
+            elif account == "holdings":
+                held = self.holdings[user_id].get(stock_id, 0) + shares
+                if held:
+                    self.holdings[user_id][stock_id] = held
+                    self.holders[stock_id][user_id] = held
+                else:
+                    self.holdings[user_id].pop(stock_id, None)
+                    self.holders[stock_id].pop(user_id, None)
+                if stock_id not in self.prices and shares:
+                    self.prices[stock_id] = float(amount) / shares
+                traded.add(stock_id)
+            else:
+                continue
+            changed.add(user_id)
+        for user_id in changed:
+            self._rank(user_id)
+        self._watch(traded)
+
+    def price(self, symbol, price):
+        """Mark a stock's holders to a new price, as a price hub listener."""
+
+        with self._lock:
+            stock_id = self.stocks.get(symbol)
+            if stock_id is None:
+                return
+            old = self.prices.get(stock_id, 0.0)
+            self.prices[stock_id] = price
+            if not self.loaded:
+                return
+            for user_id, shares in self.holders.get(stock_id, {}).items():
+                self._rank(user_id,
+                           self.totals[user_id] + shares * (price - old))
+
+    def remove(self, user_id):
+        """Drop a deleted user."""
+
+        with self._lock:
+            total = self.totals.pop(user_id, None)
+            if total is not None:
+                self.ranking.remove((-total, user_id))
+            self.cash.pop(user_id, None)
+            for stock_id in self.holdings.pop(user_id, {}):
+                self.holders[stock_id].pop(user_id, None)
+
+    def top(self, n):
+        """Return the n highest (user_id, total) pairs, highest first."""
+
+        self.refresh()
+        with self._lock:
+            leaders = []
+            for total, user_id in self.ranking:
+                if len(leaders) == n:
+                    break
+                leaders.append((user_id, -total))
+            return leaders
+
+    def rank(self, user_id):
+        """Return a user's 1-based rank and total, or None if unranked."""
+
+        self.refresh()
+        with self._lock:
+            total = self.totals.get(user_id)
+            if total is None:
+                return None
+            return self.ranking.index((-total, user_id)) + 1, total
+
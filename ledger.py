@@ -0,0 +1,224 @@
+"""The double-entry ledger behind users' cash and portfolios.
+
+Routes post ledger entries in the same database transaction as the
+`users.cash` and `portfolios` changes they record. A user's balance is their
+latest checkpoint plus the entries after it, and the nightly reconciliation
+streams only those entries, checks them against `users.cash` and
+`portfolios`, then writes new checkpoints.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import func, select
+
+from models import (db, LedgerCheckpoint, LedgerEntry, Portfolio, Stock,
+                    Transaction, TransactionType, User)
+
+# Cash every new account is opened with, matching the users.cash default
+OPENING_CASH = Decimal("10000")
+
+
+def post_opening(user, amount=OPENING_CASH):
+    """Post the opening cash of a new user."""
+
+    now = datetime.now()
+    db.session.add_all([
+        LedgerEntry(user=user, account="cash", amount=str(amount),
+                    datetime=now),
+        LedgerEntry(user=user, account="external", amount=str(-amount),
+                    datetime=now),
+    ])
+
+
+def post_trade(transaction, shares, cost):
+    """Post a trade, shares and cost are negative for a sale."""
+
+    db.session.add_all([
+        LedgerEntry(user_id=transaction.user_id, transaction=transaction,
+                    account="cash", amount=str(-cost),
+                    datetime=transaction.datetime),
+        LedgerEntry(user_id=transaction.user_id, transaction=transaction,
+                    account="holdings", stock_id=transaction.stock_id,
+                    amount=str(cost), shares=shares,
+                    datetime=transaction.datetime),
+    ])
+
+
+def post_cash(transaction, amount):
+    """Post a deposit, or a withdrawal when amount is negative."""
+
+    db.session.add_all([
+        LedgerEntry(user_id=transaction.user_id, transaction=transaction,
+                    account="cash", amount=str(amount),
+                    datetime=transaction.datetime),
+        LedgerEntry(user_id=transaction.user_id, transaction=transaction,
+                    account="external", amount=str(-amount),
+                    datetime=transaction.datetime),
+    ])
+
+
+def _latest_checkpoints():
+    """Return a subquery of each user's latest checkpoint entry_id."""
+
+    return select(LedgerCheckpoint.user_id,
+                  func.max(LedgerCheckpoint.entry_id).label("entry_id")).\
+        group_by(LedgerCheckpoint.user_id).subquery()
+
+
+def balance(user_id):
+    """Return a user's cash and {stock_id: shares} according to the ledger."""
+
+    last = db.session.query(func.max(LedgerCheckpoint.entry_id)).\
+        filter_by(user_id=user_id).scalar() or 0
+
+    cash = Decimal(0)
+    holdings = defaultdict(int)
+
+    # Start from the checkpoint
+    for row in LedgerCheckpoint.query.filter_by(user_id=user_id,
+                                                entry_id=last):
+        if row.stock_id is None:
+            cash = Decimal(row.balance)
+        else:
+            holdings[row.stock_id] = row.shares
+
+    # Then apply the short tail of entries since
+    rows = db.session.query(LedgerEntry.account, LedgerEntry.stock_id,
+                            LedgerEntry.amount, LedgerEntry.shares).\
+        filter(LedgerEntry.user_id == user_id, LedgerEntry.id > last)
+    for account, stock_id, amount, shares in rows:
+        if account == "cash":
+            cash += Decimal(amount)
+        elif account == "holdings":
+            holdings[stock_id] += shares
+
+    return cash, {stock: shares for stock, shares in holdings.items()
+                  if shares}
+
+
+def reconcile(checkpoint=True):
+    """Check every user's cash and portfolio against the ledger.
+
+    Only entries after each user's latest checkpoint are read, streamed in
+    user order, so the nightly run grows with the day's trades rather than
+    the whole ledger. When checkpoint is true, users whose balances agree
+    get a new checkpoint. Returns a list of (user_id, problem) tuples.
+    """
+
+    latest = _latest_checkpoints()
+
+    # Load the checkpointed balances, users' cash and portfolios in bulk
+    starts = {}
+    rows = db.session.query(LedgerCheckpoint).join(
+        latest, (LedgerCheckpoint.user_id == latest.c.user_id)
+        & (LedgerCheckpoint.entry_id == latest.c.entry_id))
+    for row in rows:
+        start = starts.setdefault(
+            row.user_id, [Decimal(0), defaultdict(int), defaultdict(Decimal)])
+        if row.stock_id is None:
+            start[0] = Decimal(row.balance)
+        else:
+            start[1][row.stock_id] = row.shares
+            start[2][row.stock_id] = Decimal(row.balance)
+
+    users = dict(db.session.query(User.id, User.cash))
+    portfolios = defaultdict(dict)
+    for user_id, stock_id, quantity in db.session.query(
+            Portfolio.user_id, Portfolio.stock_id, Portfolio.quantity):
+        portfolios[user_id][stock_id] = quantity
+
+    # Sum the tail of every user's entries in one streamed query
+    tails = {}
+    last_entry = {}
+    query = select(LedgerEntry.id, LedgerEntry.user_id, LedgerEntry.account,
+                   LedgerEntry.stock_id, LedgerEntry.amount,
+                   LedgerEntry.shares).\
+        outerjoin(latest, LedgerEntry.user_id == latest.c.user_id).\
+        where(LedgerEntry.id > func.coalesce(latest.c.entry_id, 0)).\
+        order_by(LedgerEntry.user_id, LedgerEntry.id).\
+        execution_options(stream_results=True)
+    for entry_id, user_id, account, stock_id, amount, shares in \
+            db.session.execute(query):
+        if user_id not in tails:
+            tails[user_id] = starts.get(
+                user_id, [Decimal(0), defaultdict(int), defaultdict(Decimal)])
+        last_entry[user_id] = entry_id
+        if account == "cash":
+            tails[user_id][0] += Decimal(amount)
+        elif account == "holdings":
+            tails[user_id][1][stock_id] += shares
+            tails[user_id][2][stock_id] += Decimal(amount)
+
+    # Compare, users with no new entries keep their checkpointed balances
+    problems = []
+    checkpoints = []
+    now = datetime.now()
+    for user_id, cash in users.items():
+        ledger = tails.get(user_id) or starts.get(user_id)
+        if ledger is None:
+            problems.append((user_id, "no ledger entries"))
+            continue
+        ledger_cash, holdings, cost = ledger
+        held = {stock: shares for stock, shares in holdings.items() if shares}
+        ok = True
+        if ledger_cash != Decimal(cash):
+            problems.append((user_id, f"cash {cash} but ledger has "
+                                      f"{ledger_cash}"))
+            ok = False
+        if held != portfolios.get(user_id, {}):
+            problems.append((user_id, f"portfolio {portfolios.get(user_id)} "
+                                      f"but ledger has {held}"))
+            ok = False
+        if ok and user_id in tails:
+            checkpoints.append({"user_id": user_id,
+                                "entry_id": last_entry[user_id],
+                                "stock_id": None, "balance": str(ledger_cash),
+                                "shares": 0, "datetime": now})
+            checkpoints.extend({"user_id": user_id,
+                                "entry_id": last_entry[user_id],
+                                "stock_id": stock, "balance": str(cost[stock]),
+                                "shares": shares, "datetime": now}
+                               for stock, shares in held.items())
+
+    if checkpoint and checkpoints:
+        db.session.execute(LedgerCheckpoint.__table__.insert(), checkpoints)
+        db.session.commit()
+
+    return problems
+
+
+def backfill():
+    """Post ledger entries for users who traded before the ledger existed.
+
+    Each such user gets the opening cash and their transactions replayed in
+    order. Returns the number of users backfilled.
+    """
+
+    posted = select(LedgerEntry.user_id).distinct()
+    user_ids = [user_id for (user_id,) in db.session.query(User.id).
+                filter(User.id.notin_(posted))]
+
+    types = dict(db.session.query(TransactionType.id, TransactionType.name))
+    withdrawal = db.session.query(Stock.id).filter_by(name="Withdrawal").\
+        scalar()
+
+    for user_id in user_ids:
+        post_opening(db.session.get(User, user_id))
+        for transaction in Transaction.query.filter_by(user_id=user_id).\
+                order_by(Transaction.id):
+            ttype = types[transaction.type_id]
+            if ttype == "CASH":
+                amount = Decimal(transaction.price)
+                if transaction.stock_id == withdrawal:
+                    amount = -amount
+                post_cash(transaction, amount)
+            else:
+                shares = transaction.quantity
+                if ttype == "SELL":
+                    shares = -shares
+                post_trade(transaction, shares,
+                           Decimal(shares) * Decimal(transaction.price))
+
+    db.session.commit()
+    return len(user_ids)
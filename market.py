@@ -0,0 +1,126 @@
+"""A simulated stock market, usable in place of the live quote providers.
+
+Every symbol's price follows a geometric random walk, moving once per tick.
+Prices are held in one array and a tick moves them all at once by mapping
+C-level functions over arrays, so quotes cost a dict lookup between ticks.
+Latency and failed lookups can be injected to imitate a real provider.
+
+The market is chosen and configured by environment variables:
+
+    QUOTE_PROVIDER      "simulated" to quote from this market, default "live"
+    MARKET_SYMBOLS      number of symbols listed, default 5000
+    MARKET_SEED         seed of the initial prices and walk, default random
+    MARKET_VOLATILITY   standard deviation of each tick's log return,
+                        default 0.001
+    MARKET_TICK         seconds per tick, default 1
+    MARKET_LATENCY      seconds each lookup waits, default 0
+    MARKET_ERROR_RATE   fraction of lookups that fail, default 0
+
+Each process runs its own market, so separate workers' prices agree only
+through the shared quote cache.
+"""
+
+import csv
+import math
+import operator
+import os
+import random
+import string
+import threading
+import time
+from array import array
+from itertools import product, repeat
+
+
+def market_config(environ=os.environ):
+    """Return the app config for the configured quote provider."""
+
+    seed = environ.get("MARKET_SEED")
+    return {
+        "QUOTE_PROVIDER": environ.get("QUOTE_PROVIDER", "live"),
+        "MARKET_SYMBOLS": int(environ.get("MARKET_SYMBOLS", 5000)),
+        "MARKET_SEED": int(seed) if seed else None,
+        "MARKET_VOLATILITY": float(environ.get("MARKET_VOLATILITY", 0.001)),
+        "MARKET_TICK": float(environ.get("MARKET_TICK", 1)),
+        "MARKET_LATENCY": float(environ.get("MARKET_LATENCY", 0)),
+        "MARKET_ERROR_RATE": float(environ.get("MARKET_ERROR_RATE", 0)),
+    }
+
+
+class SimulatedMarket:
+    """Random-walk prices for a listing of real and made-up symbols.
+
+    Symbols come from the listing file, a CSV of symbol and name, then
+    four-letter symbols are made up until there are size in all. Called with
+    a symbol, returns a quote as helpers.lookup does.
+    """
+
+    def __init__(self, listing, size=5000, seed=None, volatility=0.001,
+                 tick=1, latency=0, error_rate=0, clock=time.monotonic):
+        self.volatility = volatility
+        self.tick = tick
+        self.latency = latency
+        self.error_rate = error_rate
+        self.clock = clock
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        # Symbol, name and index of each price
+        self.names = {}
+        with open(listing, newline="") as f:
+            for row in csv.DictReader(f):
+                if len(self.names) < size:
+                    self.names[row["symbol"].strip().upper()] = \
+                        row["name"].strip()
+        made_up = ("".join(letters)
+                   for letters in product(string.ascii_uppercase, repeat=4))
+        for symbol in made_up:
+            if len(self.names) >= size:
+                break
+            self.names.setdefault(symbol, f"{symbol.title()} Simulated Inc.")
+        self._index = {symbol: i for i, symbol in enumerate(self.names)}
+
+        # Starting prices spread log-uniformly from $5 to $500
+        uniform = self._random.uniform
+        low, high = math.log(5), math.log(500)
+        self.prices = array("d", (math.exp(uniform(low, high))
+                                  for _ in self.names))
+        self._ticked = self._now()
+
+    def _now(self):
+        return int(self.clock() // self.tick)
+
+    def advance(self, ticks=1):
+        """Move every price by ticks steps of the random walk at once."""
+
+        # The log returns of several ticks sum to one of larger deviation
+        sigma = self.volatility * math.sqrt(ticks)
+        returns = map(self._random.gauss, repeat(0.0, len(self.prices)),
+                      repeat(sigma, len(self.prices)))
+        self.prices = array("d", map(operator.mul, self.prices,
+                                     map(math.exp, returns)))
+
+    def __call__(self, symbol):
+        """Return a quote for symbol, or None if unlisted or failed."""
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            return None
+
+        i = self._index.get(symbol.upper())
+        if i is None:
+            return None
+
+        # Catch up on the ticks since the last quote
+        now = self._now()
+        if now != self._ticked:
+            with self._lock:
+                if now > self._ticked:
+                    self.advance(now - self._ticked)
+                    self._ticked = now
+
+        symbol = symbol.upper()
+        return {"name": self.names[symbol],
+                "price": round(self.prices[i], 2),
+                "symbol": symbol}
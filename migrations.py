@@ -0,0 +1,206 @@
+"""Versioned schema migrations for CS50 Finance.
+
+Each migration is a version number, a description and a list of steps,
+each an SQL statement or a function called with the connection. Applied
+versions are recorded in the schema_migrations table so `flask db-upgrade`
+only runs those not yet applied. Statements use IF NOT EXISTS so a database
+created by db.create_all() from the current models can be upgraded without
+error.
+
+Tables are created from definitions frozen as they stood at their version,
+never from the models, so that changing a model later does not change what
+an old migration creates.
+"""
+
+from datetime import datetime
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer,
+                        LargeBinary, MetaData, Table, Text, text)
+
+from models import db
+
+
+def _metadata():
+    """Return metadata declaring the tables that migrations refer to.
+
+    Only their ids are declared, for foreign keys to them to resolve.
+    """
+
+    metadata = MetaData()
+    for name in ("users", "stocks", "transactions"):
+        Table(name, metadata, Column("id", Integer, primary_key=True))
+    return metadata
+
+
+def _create(metadata, name):
+    """Return a migration step creating a frozen table and its indexes."""
+    return lambda conn: metadata.tables[name].create(conn, checkfirst=True)
+
+
+# Version 2
+_LEDGER = _metadata()
+Table("ledger_entries", _LEDGER,
+      Column("id", Integer, primary_key=True, nullable=False),
+      Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+      Column("transaction_id", Integer, ForeignKey("transactions.id")),
+      Column("account", Text, nullable=False),
+      Column("stock_id", Integer, ForeignKey("stocks.id")),
+      Column("amount", Text, nullable=False),
+      Column("shares", Integer, nullable=False),
+      Column("datetime", DateTime, nullable=False),
+      Index("ix_ledger_entries_user", "user_id", "id"))
+Table("ledger_checkpoints", _LEDGER,
+      Column("id", Integer, primary_key=True, nullable=False),
+      Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+      Column("entry_id", Integer, nullable=False),
+      Column("stock_id", Integer, ForeignKey("stocks.id")),
+      Column("balance", Text, nullable=False),
+      Column("shares", Integer, nullable=False),
+      Column("datetime", DateTime, nullable=False),
+      Index("ix_ledger_checkpoints_user", "user_id", "entry_id"))
+
+# Version 3
+_ORDERS = _metadata()
+Table("orders", _ORDERS,
+      Column("id", Integer, primary_key=True, nullable=False),
+      Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+      Column("symbol", Text, nullable=False),
+      Column("name", Text, nullable=False),
+      Column("side", Text, nullable=False),
+      Column("kind", Text, nullable=False),
+      Column("price", Text, nullable=False),
+      Column("quantity", Integer, nullable=False),
+      Column("status", Text, nullable=False),
+      Column("datetime", DateTime, nullable=False),
+      Column("filled", DateTime),
+      Index("ix_orders_user_status", "user_id", "status"),
+      Index("ix_orders_status", "status"))
+
+# Version 4
+_IDEMPOTENCY = _metadata()
+Table("idempotency_keys", _IDEMPOTENCY,
+      Column("id", Integer, primary_key=True, nullable=False),
+      Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+      Column("key", Text, nullable=False),
+      Column("path", Text, nullable=False),
+      Column("fingerprint", Text, nullable=False),
+      Column("status", Integer),
+      Column("location", Text),
+      Column("mimetype", Text),
+      Column("body", LargeBinary),
+      Column("expires", DateTime, nullable=False),
+      Index("ix_idempotency_keys_user_key", "user_id", "key", unique=True),
+      Index("ix_idempotency_keys_expires", "expires"))
+
+MIGRATIONS = [
+    (1, "Index portfolios and transactions for the trade and history "
+        "queries", [
+        # buy() and sell() find a user's holding of one stock, there should
+        # only ever be one such row. Older databases may have several, so
+        # each holding's quantities are merged into its first row first.
+        "UPDATE portfolios SET quantity = ("
+        "SELECT SUM(quantity) FROM portfolios AS p "
+        "WHERE p.user_id = portfolios.user_id "
+        "AND p.stock_id = portfolios.stock_id) "
+        "WHERE id IN (SELECT MIN(id) FROM portfolios "
+        "GROUP BY user_id, stock_id HAVING COUNT(*) > 1)",
+        "DELETE FROM portfolios WHERE id NOT IN ("
+        "SELECT MIN(id) FROM portfolios GROUP BY user_id, stock_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_portfolios_user_stock "
+        "ON portfolios (user_id, stock_id)",
+        # history() loads a user's transactions in insertion order
+        "CREATE INDEX IF NOT EXISTS ix_transactions_user "
+        "ON transactions (user_id)",
+        # index() falls back to the latest price traded for a stock
+        "CREATE INDEX IF NOT EXISTS ix_transactions_stock_datetime "
+        "ON transactions (stock_id, datetime)",
+    ]),
+    (2, "Add the ledger and its checkpoints", [
+        _create(_LEDGER, "ledger_entries"),
+        _create(_LEDGER, "ledger_checkpoints"),
+    ]),
+    (3, "Add resting limit and stop orders", [
+        _create(_ORDERS, "orders"),
+    ]),
+    (4, "Add idempotency keys for trade submissions", [
+        _create(_IDEMPOTENCY, "idempotency_keys"),
+    ]),
+]
+
+# The queries run by the routes, with the index each is expected to use.
+# Stock lookups by symbol and by name (for the "Deposit" and "Withdrawal"
+# pseudo-stocks) use the indexes created for their unique constraints, named
+# differently by SQLite and PostgreSQL.
+HOT_QUERIES = [
+    ("buy", "SELECT id FROM portfolios WHERE user_id = 1 AND stock_id = 1",
+     "ix_portfolios_user_stock"),
+    ("sell", "SELECT id FROM portfolios WHERE user_id = 1",
+     "ix_portfolios_user_stock"),
+    ("history", "SELECT id FROM transactions WHERE user_id = 1",
+     "ix_transactions_user"),
+    ("index", "SELECT price FROM transactions WHERE stock_id = 1 "
+     "ORDER BY datetime DESC LIMIT 1", "ix_transactions_stock_datetime"),
+    ("buy", "SELECT id FROM stocks WHERE symbol = 'AAPL'",
+     ("sqlite_autoindex_stocks_1", "stocks_symbol_key")),
+    ("cash_transaction", "SELECT id FROM stocks WHERE name = 'Deposit'",
+     ("sqlite_autoindex_stocks_2", "stocks_name_key")),
+    ("idempotent", "SELECT id FROM idempotency_keys "
+     "WHERE user_id = 1 AND key = 'k'", "ix_idempotency_keys_user_key"),
+]
+
+
+def current_version(conn):
+    """Return the latest migration version applied to the database."""
+
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                      "version INTEGER PRIMARY KEY NOT NULL, "
+                      "description TEXT NOT NULL, "
+                      "applied_at TIMESTAMP NOT NULL)"))
+    version = conn.execute(
+        text("SELECT MAX(version) FROM schema_migrations")).scalar()
+    return version or 0
+
+
+def upgrade():
+    """Apply, in order, each migration not yet applied to the database.
+
+    Returns the list of versions applied.
+    """
+
+    applied = []
+    with db.engine.begin() as conn:
+        version = current_version(conn)
+        for number, description, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            conn.execute(text("INSERT INTO schema_migrations "
+                              "(version, description, applied_at) "
+                              "VALUES (:version, :description, :applied_at)"),
+                         {"version": number, "description": description,
+                          "applied_at": datetime.now()})
+            applied.append(number)
+    return applied
+
+
+def explain_hot_queries():
+    """Check the plan the database chooses for each hot query uses its index.
+
+    Returns a list of (route, sql, index, plan, ok) tuples.
+    """
+
+    results = []
+    with db.engine.connect() as conn:
+        explain = ("EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite"
+                   else "EXPLAIN ")
+        for route, sql, index in HOT_QUERIES:
+            if isinstance(index, str):
+                index = (index,)
+            rows = conn.execute(text(explain + sql)).fetchall()
+            plan = "; ".join(row[-1] for row in rows)
+            ok = any(name in plan for name in index)
+            results.append((route, sql, index[0], plan, ok))
+    return results
@@ -0,0 +1,283 @@
+"""Database models for CS50 Finance."""
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exc, exists
+
+from database import RoutingSession
+
+# The database object, bound to an app by application.create_app()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# The three types of transactions the database allows
+TRANSACTION_TYPES = ("BUY", "SELL", "CASH")
+
+# Cache of transaction type name to id, filled on first use per process
+_transaction_type_ids = {}
+
+
+class User(db.Model):
+    """The users table in our database."""
+
+    __tablename__ = "users"
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    username = db.Column(db.Text, nullable=False, unique=True)
+    hash = db.Column(db.Text, nullable=False)
+    cash = db.Column(db.Text, nullable=False, default="10000")
+
+    transactions = db.relationship("Transaction", back_populates="user",
+                                   cascade="all, delete-orphan")
+    portfolio = db.relationship("Portfolio", back_populates="user",
+                                cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return (f"<User(id={self.id}, username={self.username}, "
+                f"hash={self.hash}, cash={self.cash})>")
+
+
+class Portfolio(db.Model):
+    """The portfolios table in our database"""
+
+    __tablename__ = "portfolios"
+    __table_args__ = (
+        db.Index("ix_portfolios_user_stock", "user_id", "stock_id",
+                 unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stocks.id'),
+                         nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+    user = db.relationship("User", back_populates="portfolio")
+    stock = db.relationship("Stock", back_populates="portfolios")
+
+    def __repr__(self):
+        return (f"<Portfolio(id={self.id}, user_id={self.user_id}, "
+                f"stock_id={self.stock_id}, quantity={self.quantity})>")
+
+
+class Stock(db.Model):
+    """The stocks table in our database."""
+
+    __tablename__ = "stocks"
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    symbol = db.Column(db.Text, unique=True)
+    name = db.Column(db.Text, unique=True)
+
+    transactions = db.relationship("Transaction", back_populates="stock")
+    portfolios = db.relationship("Portfolio", back_populates="stock")
+
+    def __repr__(self):
+        return f"<Stock(id={self.id}, symbol={self.symbol})>"
+
+
+class TransactionType(db.Model):
+    """The table for the three types of transactions in our database"""
+
+    __tablename__ = "transaction_types"
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    name = db.Column(db.Text, unique=True)
+
+    transactions = db.relationship("Transaction", back_populates="ttype")
+
+    def __repr__(self):
+        return f"<TransactionType(id={self.id}, name={self.name}>"
+
+
+class Transaction(db.Model):
+    """The Transactions table in our database."""
+
+    __tablename__ = "transactions"
+    __table_args__ = (
+        db.Index("ix_transactions_user", "user_id"),
+        db.Index("ix_transactions_stock_datetime", "stock_id", "datetime"),
+    )
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stocks.id'),
+                         nullable=False)
+    type_id = db.Column(db.Integer, db.ForeignKey('transaction_types.id'),
+                        nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Text, nullable=False)
+    datetime = db.Column(db.DateTime, nullable=False)
+
+    user = db.relationship("User", back_populates="transactions")
+    stock = db.relationship("Stock", back_populates="transactions")
+    ttype = db.relationship("TransactionType", back_populates="transactions")
+
+    def __repr__(self):
+        return (f"<Transaction(id={self.id}, user_id={self.user_id}, "
+                f"stock_id={self.stock_id}, "
+                f"type_id={self.type_id}, "
+                f"quantity={self.quantity}, price={self.price}, "
+                f"datetime={self.datetime})>")
+
+
+class LedgerEntry(db.Model):
+    """The append-only double-entry ledger in our database.
+
+    Each transaction posts entries whose amounts sum to zero across the
+    user's "cash" and "holdings" accounts and the "external" account money
+    is deposited from and withdrawn to. Holdings entries also carry the
+    change in shares.
+    """
+
+    __tablename__ = "ledger_entries"
+    __table_args__ = (
+        db.Index("ix_ledger_entries_user", "user_id", "id"),
+    )
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'))
+    account = db.Column(db.Text, nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stocks.id'))
+    amount = db.Column(db.Text, nullable=False)
+    shares = db.Column(db.Integer, nullable=False, default=0)
+    datetime = db.Column(db.DateTime, nullable=False)
+
+    user = db.relationship("User")
+    transaction = db.relationship("Transaction")
+
+    def __repr__(self):
+        return (f"<LedgerEntry(id={self.id}, user_id={self.user_id}, "
+                f"transaction_id={self.transaction_id}, "
+                f"account={self.account}, stock_id={self.stock_id}, "
+                f"amount={self.amount}, shares={self.shares})>")
+
+
+class LedgerCheckpoint(db.Model):
+    """The per-user balance checkpoints of the ledger in our database.
+
+    A checkpoint is the set of rows for a user sharing an entry_id, the last
+    ledger entry they include. The row with no stock_id holds the cash
+    balance, the others the shares of each holding and the net cash paid for
+    it: purchases less sale proceeds, negative once sales have returned more
+    than was paid.
+    """
+
+    __tablename__ = "ledger_checkpoints"
+    __table_args__ = (
+        db.Index("ix_ledger_checkpoints_user", "user_id", "entry_id"),
+    )
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    entry_id = db.Column(db.Integer, nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stocks.id'))
+    balance = db.Column(db.Text, nullable=False)
+    shares = db.Column(db.Integer, nullable=False, default=0)
+    datetime = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return (f"<LedgerCheckpoint(id={self.id}, user_id={self.user_id}, "
+                f"entry_id={self.entry_id}, stock_id={self.stock_id}, "
+                f"balance={self.balance}, shares={self.shares})>")
+
+
+class Order(db.Model):
+    """The resting limit and stop orders in our database."""
+
+    __tablename__ = "orders"
+    __table_args__ = (
+        db.Index("ix_orders_user_status", "user_id", "status"),
+        db.Index("ix_orders_status", "status"),
+    )
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    symbol = db.Column(db.Text, nullable=False)
+    name = db.Column(db.Text, nullable=False)
+    side = db.Column(db.Text, nullable=False)
+    kind = db.Column(db.Text, nullable=False)
+    price = db.Column(db.Text, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.Text, nullable=False, default="OPEN")
+    datetime = db.Column(db.DateTime, nullable=False)
+    filled = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return (f"<Order(id={self.id}, user_id={self.user_id}, "
+                f"symbol={self.symbol}, side={self.side}, kind={self.kind}, "
+                f"price={self.price}, quantity={self.quantity}, "
+                f"status={self.status})>")
+
+
+class IdempotencyKey(db.Model):
+    """The keys of recent trade submissions and the responses to them."""
+
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        db.Index("ix_idempotency_keys_user_key", "user_id", "key",
+                 unique=True),
+        db.Index("ix_idempotency_keys_expires", "expires"),
+    )
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    key = db.Column(db.Text, nullable=False)
+    path = db.Column(db.Text, nullable=False)
+    fingerprint = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Integer)
+    location = db.Column(db.Text)
+    mimetype = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    expires = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return (f"<IdempotencyKey(id={self.id}, user_id={self.user_id}, "
+                f"key={self.key}, path={self.path}, status={self.status})>")
+
+
+def bootstrap():
+    """Create any missing tables and seed the transaction types.
+
+    Run once per deployment via `flask init-db`, never while serving.
+    """
+
+    # Create database tables if not already existing, on the primary only as
+    # a read replica gets them from it
+    db.create_all(bind_key=None)
+
+    # Add, if not already existing, the three transaction types the database
+    # allows, using a single query to find those already present
+    existing = {name for (name,) in db.session.query(TransactionType.name)}
+    for name in TRANSACTION_TYPES:
+        if name not in existing:
+            db.session.add(TransactionType(name=name))
+
+    # Commit changes
+    try:
+        db.session.commit()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        raise
+
+    _transaction_type_ids.clear()
+
+
+def transaction_type_id(name):
+    """Return the id of the named transaction type, cached after first use."""
+
+    if not _transaction_type_ids:
+        _transaction_type_ids.update(
+            db.session.query(TransactionType.name, TransactionType.id))
+    return _transaction_type_ids[name]
+
+
+def delete_orphan_stocks():
+    """Delete, in one statement, stocks no longer in any transaction.
+
+    Each NOT EXISTS probe is answered by the transactions(stock_id) index.
+    """
+
+    stocks = Stock.__table__
+    db.session.execute(stocks.delete().where(
+        ~exists().where(Transaction.stock_id == stocks.c.id)))
+
+
+def delete_user_rows(user_id):
+    """Delete a user and every row belonging to them with bulk statements."""
+
+    for model in (IdempotencyKey, Order, LedgerCheckpoint, LedgerEntry,
+                  Transaction, Portfolio):
+        model.query.filter_by(user_id=user_id).\
+            delete(synchronize_session=False)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
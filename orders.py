@@ -0,0 +1,287 @@
+"""Resting limit and stop orders triggered by incoming quotes.
+
+Open orders are kept in the orders table and, in memory, in two heaps per
+symbol keyed by trigger price: one for orders that fire when the price falls
+to their trigger (buy limits and sell stops) and one for orders that fire
+when it rises to it (sell limits and buy stops). A quote only pops the
+orders it crosses, each in O(log n), and the rest are never looked at.
+
+When several worker processes serve the app, only the one holding the order
+engine's file lock executes orders. It loads the open orders once when it
+takes over, in batches between which other greenlets run, then every
+interval picks up only the orders placed since through the other workers.
+Orders cancelled through other workers stay in its book and are skipped
+when they trigger.
+"""
+
+import fcntl
+import heapq
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import exc
+
+from helpers import cooperate
+from models import db, Order
+
+SIDES = ("BUY", "SELL")
+KINDS = ("LIMIT", "STOP")
+
+# Seconds between attempts to take the order engine's lock
+LEAD_POLL = 1
+
+# Orders within this many ids of the newest synced are read again, as on
+# PostgreSQL an order can commit after one with a higher id
+SYNC_WINDOW = 1000
+
+# Orders read at a time when syncing
+SYNC_BATCH = 2000
+
+
+def fires_on_fall(side, kind):
+    """Return whether an order fires when the price falls to its trigger."""
+    return (side, kind) in (("BUY", "LIMIT"), ("SELL", "STOP"))
+
+
+class OrderBook:
+    """Per-symbol heaps of resting orders keyed by trigger price."""
+
+    def __init__(self):
+        # symbol -> max-heap of (-price, id) and min-heap of (price, id)
+        self._heaps = defaultdict(lambda: ([], []))
+        self._cancelled = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(falls) + len(rises)
+                   for falls, rises in self._heaps.values())
+
+    def symbols(self):
+        """Return the symbols with resting orders."""
+        return list(self._heaps)
+
+    def add(self, order_id, symbol, side, kind, price):
+        """Add an order to the book."""
+
+        with self._lock:
+            falls, rises = self._heaps[symbol]
+            if fires_on_fall(side, kind):
+                heapq.heappush(falls, (-price, order_id))
+            else:
+                heapq.heappush(rises, (price, order_id))
+
+    def cancel(self, order_id):
+        """Remove an order, lazily, the next time its heap reaches it."""
+
+        with self._lock:
+            self._cancelled.add(order_id)
+
+    def crossed(self, symbol, price):
+        """Remove and return the ids of the orders price triggers."""
+
+        triggered = []
+        with self._lock:
+            if symbol not in self._heaps:
+                return triggered
+            falls, rises = self._heaps[symbol]
+            while falls and -falls[0][0] >= price:
+                triggered.append(heapq.heappop(falls)[1])
+            while rises and rises[0][0] <= price:
+                triggered.append(heapq.heappop(rises)[1])
+            if not falls and not rises:
+                del self._heaps[symbol]
+            if self._cancelled:
+                live = [order_id for order_id in triggered
+                        if order_id not in self._cancelled]
+                self._cancelled.difference_update(triggered)
+                triggered = live
+        return triggered
+
+
+class OrderEngine:
+    """Executes resting orders as quotes arrive from the price hub.
+
+    execute is called in an app context with an open order and the price and
+    returns an error message, or None once the trade is recorded. With a
+    lock_path only the process holding that file's lock executes orders, and
+    the others leave newly placed orders for it to find every interval.
+    """
+
+    def __init__(self, app, hub, execute, lock_path=None, interval=15):
+        self.app = app
+        self.hub = hub
+        self.execute = execute
+        self.lock_path = lock_path
+        self.interval = interval
+        self.book = OrderBook()
+        self.pending = queue.Queue()
+        self.leading = False
+        self._synced = 0
+        self._rested = set()
+        self._retry = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start waiting to lead, then execute orders, once."""
+
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def add(self, order):
+        """Rest a newly placed order."""
+
+        with self._lock:
+            if not self.leading:
+                return
+            self._rested.add(order.id)
+            self.book.add(order.id, order.symbol, order.side, order.kind,
+                          float(order.price))
+        self.hub.subscribe([order.symbol], self.pending)
+
+    def cancel(self, order):
+        """Stop a cancelled order from triggering."""
+        self.book.cancel(order.id)
+
+    def _lead(self):
+        """Wait until this process holds the lock, which it keeps."""
+
+        if self.lock_path is None:
+            return
+        self._lock_file = open(self.lock_path, "a")
+
+        # Polled, as a blocking flock would stall a gevent worker's greenlets
+        while True:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                time.sleep(LEAD_POLL)
+
+    def _sync(self):
+        """Rest the open orders placed since the last sync, or all at first.
+
+        Orders whose execution raised are rested again too.
+        """
+
+        with self._lock:
+            retry = set(self._retry)
+        columns = (Order.id, Order.symbol, Order.side, Order.kind,
+                   Order.price)
+        symbols = set()
+        with self.app.app_context():
+            if retry:
+                self._rest(db.session.query(*columns).
+                           filter(Order.status == "OPEN",
+                                  Order.id.in_(retry)).all(),
+                           retry, symbols)
+
+            after = self._synced - SYNC_WINDOW
+            while True:
+                orders = db.session.query(*columns).\
+                    filter(Order.status == "OPEN", Order.id > after).\
+                    order_by(Order.id).limit(SYNC_BATCH).all()
+                self._rest(orders, (), symbols)
+                if len(orders) < SYNC_BATCH:
+                    break
+                after = orders[-1].id
+                cooperate()
+        with self._lock:
+            self.leading = True
+            self._retry -= retry
+
+            # Orders below the window are never read again
+            self._rested = {order_id for order_id in self._rested
+                            if order_id > self._synced - SYNC_WINDOW}
+        self.hub.subscribe(symbols, self.pending)
+
+    def _rest(self, orders, retry, symbols):
+        """Rest orders not yet rested or being retried, noting symbols."""
+
+        with self._lock:
+            for order_id, symbol, side, kind, price in orders:
+                if order_id not in self._rested or order_id in retry:
+                    self.book.add(order_id, symbol, side, kind, float(price))
+                    self._rested.add(order_id)
+                    symbols.add(symbol)
+            if orders:
+                self._synced = max(self._synced,
+                                   max(order.id for order in orders))
+
+    def _run(self):
+        """Wait to lead, then handle quotes as they arrive."""
+
+        self._lead()
+        while True:
+            # Errors are logged and the loop carries on, as the lock stays
+            # held and no other process would take over
+            try:
+                self._sync()
+            except Exception:
+                self.app.logger.exception("Order engine failed to sync")
+            deadline = time.monotonic() + self.interval
+            while time.monotonic() < deadline:
+                try:
+                    symbol, price = self.pending.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                try:
+                    self.on_quote(symbol, price)
+                except Exception:
+                    self.app.logger.exception(
+                        "Order engine failed on a quote for %s", symbol)
+
+    def on_quote(self, symbol, price):
+        """Execute each order the quote crosses through the trade path."""
+
+        triggered = self.book.crossed(symbol, price)
+        if not triggered:
+            return
+        with self.app.app_context():
+            for order_id in triggered:
+                try:
+                    self._fill(order_id, price)
+                except Exception:
+                    db.session.rollback()
+                    with self._lock:
+                        self._retry.add(order_id)
+                    self.app.logger.exception(
+                        "Order %d could not be executed, it is rested "
+                        "again at the next sync", order_id)
+
+    def _fill(self, order_id, price):
+        """Execute an order unless it was cancelled, and record the outcome.
+
+        The order's row stays locked until the commit, so a cancel waits
+        for it, where the database supports row locks.
+        """
+
+        order = Order.query.filter_by(id=order_id).with_for_update().first()
+        if order is None or order.status != "OPEN":
+            db.session.rollback()
+            return
+        try:
+            error = self.execute(order, price)
+        except exc.SQLAlchemyError as e:
+            error = str(e)
+        if error:
+            db.session.rollback()
+            order = Order.query.filter_by(id=order_id).\
+                with_for_update().first()
+            if order is None or order.status != "OPEN":
+                db.session.rollback()
+                return
+            order.status = "FAILED"
+            self.app.logger.info("Order %d failed: %s", order_id, error)
+        else:
+            order.status = "FILLED"
+        order.filled = datetime.now()
+        db.session.commit()
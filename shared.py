@@ -0,0 +1,177 @@
+"""State shared by every worker process serving the app on one host.
+
+Sessions, cached quotes and rate limit counters must be seen by whichever
+worker handles the next request, so rather than living in one process they
+are kept in a small SQLite file of expiring key-value pairs. SQLite in WAL
+mode lets the workers read concurrently and serialises their writes.
+"""
+
+import pickle
+import sqlite3
+import threading
+import time
+
+from cachelib import BaseCache
+
+# Expired entries are deleted once every this many writes
+PRUNE_EVERY = 1000
+
+
+class SharedStore(BaseCache):
+    """Expiring key-value store in a SQLite file, usable as a cachelib cache.
+
+    A timeout of 0 never expires, None uses default_timeout.
+    """
+
+    def __init__(self, path, default_timeout=300):
+        super().__init__(default_timeout)
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._created = False
+
+    @property
+    def _db(self):
+        """Return this thread's connection, opening it on first use.
+
+        Under gevent workers each request runs in its own greenlet and
+        opens its own connection, so the table is only created once.
+        """
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10,
+                                   isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._created:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                             "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                             "expires REAL NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_expires "
+                             "ON entries (expires)")
+                self._created = True
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection, if it has one."""
+
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout else float("inf")
+
+    def _written(self):
+        """Count a write, deleting expired entries now and then."""
+
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self._db.execute("DELETE FROM entries WHERE expires <= ?",
+                             (time.time(),))
+
+    def get(self, key):
+        row = self._db.execute(
+            "SELECT value FROM entries WHERE key = ? AND expires > ?",
+            (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def has(self, key):
+        return self._db.execute(
+            "SELECT 1 FROM entries WHERE key = ? AND expires > ?",
+            (key, time.time())).fetchone() is not None
+
+    def set(self, key, value, timeout=None):
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+            (key, pickle.dumps(value), self._expires(timeout)))
+        self._written()
+        return True
+
+    def add(self, key, value, timeout=None):
+        """Set key only if it is missing or expired, returning whether."""
+
+        added = self._db.execute(
+            "INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT (key) DO "
+            "UPDATE SET value = excluded.value, expires = excluded.expires "
+            "WHERE entries.expires <= ?",
+            (key, pickle.dumps(value), self._expires(timeout),
+             time.time())).rowcount == 1
+        self._written()
+        return added
+
+    def delete(self, key):
+        return self._db.execute("DELETE FROM entries WHERE key = ?",
+                                (key,)).rowcount == 1
+
+    def clear(self):
+        self._db.execute("DELETE FROM entries")
+        return True
+
+    def inc(self, key, delta=1, timeout=None):
+        """Add delta to the number at key, keeping its expiry if it has one.
+
+        Missing or expired keys start from 0 and expire after timeout.
+        """
+
+        conn = self._db
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value, expires FROM entries WHERE key = ?",
+                (key,)).fetchone()
+            if row and row[1] > now:
+                value, expires = pickle.loads(row[0]) + delta, row[1]
+            else:
+                value, expires = delta, self._expires(timeout)
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                         (key, pickle.dumps(value), expires))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._written()
+        return value
+
+
+class QuoteCache:
+    """Wraps a lookup function, sharing each quote for ttl seconds.
+
+    Every worker's requests and price hub then share one upstream call per
+    symbol per ttl. Failed lookups are not cached.
+    """
+
+    def __init__(self, store, lookup, ttl=10):
+        self.store = store
+        self.lookup = lookup
+        self.ttl = ttl
+
+    def __call__(self, symbol):
+        key = "quote:" + symbol.upper()
+        quoted = self.store.get(key)
+        if quoted is None:
+            quoted = self.lookup(symbol)
+            if quoted and self.ttl:
+                self.store.set(key, quoted, self.ttl)
+        return quoted
+
+
+class RateLimiter:
+    """Allows each key at most limit hits per period seconds."""
+
+    def __init__(self, store, limit, period=60):
+        self.store = store
+        self.limit = limit
+        self.period = period
+
+    def hit(self, key):
+        """Count a hit on key and return whether it is within the limit."""
+
+        window = int(time.time() // self.period)
+        return self.store.inc(f"rate:{key}:{window}",
+                              timeout=self.period) <= self.limit
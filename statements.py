@@ -0,0 +1,142 @@
+"""Monthly account statements and transaction exports, run as jobs.
+
+Both stream the user's transactions from the database in id order rather
+than loading them all, so a long history costs time but not memory. A
+statement folds the transactions before the month into the opening
+balances, then records the month's trades, cash movements and realised
+profit against the average cost of each holding.
+"""
+
+import csv
+import os
+import os.path
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from flask import current_app
+from sqlalchemy import select
+
+from equity import daily_closes
+from helpers import cooperate
+from ledger import OPENING_CASH
+from models import db, Stock, Transaction, TransactionType
+
+# Rows fetched from the database at a time
+BATCH = 1000
+
+
+def _transactions(user_id, before):
+    """Yield the user's transactions before a datetime, oldest first."""
+
+    query = select(Transaction.datetime, TransactionType.name, Stock.symbol,
+                   Stock.name, Transaction.quantity, Transaction.price).\
+        join(TransactionType).join(Stock).\
+        where(Transaction.user_id == user_id,
+              Transaction.datetime < before).\
+        order_by(Transaction.id).\
+        execution_options(stream_results=True, yield_per=BATCH)
+    for i, row in enumerate(db.session.execute(query), 1):
+        # Let other requests run between batches under gevent workers
+        if i % BATCH == 0:
+            cooperate()
+        yield row
+
+
+def _valued(cash, holdings, prices, when):
+    """Return cash and holdings valued at the close before when."""
+
+    store = current_app.extensions["bars"]
+    rows = []
+    for symbol, (shares, cost) in sorted(holdings.items()):
+        if not shares:
+            continue
+        price = Decimal(str(daily_closes(store, symbol, [when.timestamp()],
+                                         float(prices[symbol]))[0]))
+        rows.append({"symbol": symbol, "shares": shares,
+                     "price": float(price), "value": float(shares * price),
+                     "cost": float(cost)})
+    return {"cash": float(cash), "holdings": rows,
+            "total": float(cash) + sum(row["value"] for row in rows)}
+
+
+def monthly_statement(user_id, month):
+    """Return the statement of a user's account for month, as "YYYY-MM"."""
+
+    start = datetime.strptime(month, "%Y-%m")
+    end = start.replace(year=start.year + start.month // 12,
+                        month=start.month % 12 + 1)
+
+    cash = OPENING_CASH
+    holdings = {}
+    prices = {}
+    opening = None
+    trades = []
+    deposits = withdrawals = realised = Decimal(0)
+
+    for when, ttype, symbol, name, quantity, price in \
+            _transactions(user_id, end):
+        if opening is None and when >= start:
+            opening = _valued(cash, holdings, prices, start)
+        price = Decimal(price)
+        during = when >= start
+
+        if ttype == "CASH":
+            if name == "Withdrawal":
+                cash -= price
+                withdrawals += price if during else 0
+            else:
+                cash += price
+                deposits += price if during else 0
+            continue
+
+        # Holdings are carried at average cost
+        shares, cost = holdings.get(symbol, (0, Decimal(0)))
+        prices[symbol] = price
+        if ttype == "BUY":
+            cash -= quantity * price
+            holdings[symbol] = (shares + quantity, cost + quantity * price)
+            gain = None
+        else:
+            cash += quantity * price
+            sold = cost * quantity / shares if shares else Decimal(0)
+            holdings[symbol] = (shares - quantity, cost - sold)
+            gain = quantity * price - sold
+            realised += gain if during else 0
+        if during:
+            trades.append({"datetime": when.isoformat(sep=" "),
+                           "type": ttype, "symbol": symbol,
+                           "quantity": quantity, "price": float(price),
+                           "total": float(quantity * price),
+                           "gain": None if gain is None else float(gain)})
+
+    if opening is None:
+        opening = _valued(cash, holdings, prices, start)
+    closing = _valued(cash, holdings, prices, end)
+    unrealised = sum(row["value"] - row["cost"]
+                     for row in closing["holdings"])
+    return {"month": month, "opening": opening, "closing": closing,
+            "deposits": float(deposits), "withdrawals": float(withdrawals),
+            "trades": trades, "realised": float(realised),
+            "unrealised": unrealised,
+            "pnl": closing["total"] - opening["total"]
+            - float(deposits - withdrawals)}
+
+
+def export_transactions(user_id):
+    """Write the user's transactions to a CSV file in EXPORTS_DIR.
+
+    Returns the file's name and the number of rows written.
+    """
+
+    directory = current_app.config["EXPORTS_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    name = f"transactions-{user_id}-{uuid.uuid4().hex}.csv"
+    rows = 0
+    with open(os.path.join(directory, name), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["datetime", "type", "symbol", "name", "quantity",
+                         "price"])
+        for row in _transactions(user_id, datetime.max):
+            writer.writerow(row)
+            rows += 1
+    return {"file": name, "rows": rows}
@@ -0,0 +1,20 @@
+// Suggest listed symbols in a datalist as the user types
+document.querySelectorAll("input[list=symbols]").forEach(function(input) {
+    var list = document.getElementById("symbols");
+    input.addEventListener("input", function() {
+        if (!input.value) {
+            return;
+        }
+        fetch("/symbols?q=" + encodeURIComponent(input.value))
+            .then(function(response) { return response.json(); })
+            .then(function(matches) {
+                list.innerHTML = "";
+                matches.forEach(function(match) {
+                    var option = document.createElement("option");
+                    option.value = match.symbol;
+                    option.label = match.name;
+                    list.appendChild(option);
+                });
+            });
+    });
+});
@@ -0,0 +1,150 @@
+"""Live price updates pushed to browsers over Server-Sent Events.
+
+A single PriceHub per process polls each symbol that anyone is watching
+once per interval, however many clients hold it, and fans changed prices out
+to a queue per connected client.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+
+class PriceHub:
+    """Shared in-process fan-out of price changes to subscribed clients.
+
+    Listeners are also called with each changed price, for instance to
+    record price history. Errors from lookups and listeners are logged to
+    logger and polling carries on.
+    """
+
+    def __init__(self, lookup, interval=15, max_pending=100, logger=None):
+        self.lookup = lookup
+        self.interval = interval
+        self.max_pending = max_pending
+        self.logger = logger or logging.getLogger(__name__)
+        self.prices = {}
+        self.listeners = []
+        self._subscribers = defaultdict(set)
+        self._watched = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, symbols, pending=None):
+        """Return a queue receiving (symbol, price) for each of symbols.
+
+        An existing queue may be passed to add symbols to it.
+        """
+
+        if pending is None:
+            pending = queue.Queue(self.max_pending)
+        with self._lock:
+            for symbol in symbols:
+                self._subscribers[symbol].add(pending)
+            self._start()
+        return pending
+
+    def watch(self, symbols):
+        """Keep polling symbols for the listeners, with or without clients."""
+
+        with self._lock:
+            self._watched.update(symbols)
+            self._start()
+
+    def unsubscribe(self, pending, symbols):
+        """Stop sending prices to the queue, forgetting unwatched symbols."""
+
+        with self._lock:
+            for symbol in symbols:
+                subscribers = self._subscribers.get(symbol)
+                if subscribers is None:
+                    continue
+                subscribers.discard(pending)
+                if not subscribers:
+                    del self._subscribers[symbol]
+                    if symbol not in self._watched:
+                        self.prices.pop(symbol, None)
+
+    def _start(self):
+        """Start polling, the caller holding the lock."""
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def publish(self, symbol, price):
+        """Send a price to everyone watching symbol if it has changed."""
+
+        if self.prices.get(symbol) == price:
+            return
+        self.prices[symbol] = price
+        for listener in self.listeners:
+            try:
+                listener(symbol, price)
+            except Exception:
+                self.logger.exception("Price listener %r failed on %s",
+                                      listener, symbol)
+        with self._lock:
+            subscribers = list(self._subscribers.get(symbol, ()))
+        for pending in subscribers:
+            try:
+                pending.put_nowait((symbol, price))
+            except queue.Full:
+                # A client this far behind will catch up on the next change
+                pass
+
+    def _run(self):
+        """Poll every watched symbol once per interval."""
+
+        while True:
+            with self._lock:
+                symbols = list(self._subscribers.keys() | self._watched)
+            for symbol in symbols:
+                try:
+                    quoted = self.lookup(symbol)
+                except Exception:
+                    self.logger.exception("Price lookup failed for %s",
+                                          symbol)
+                    continue
+                if quoted:
+                    self.publish(symbol, quoted["price"])
+            time.sleep(self.interval)
+
+
+def portfolio_events(hub, holdings, cash, heartbeat=30):
+    """Yield SSE messages with the changed price and value of each holding.
+
+    holdings maps symbol to quantity and cash is the user's cash, both as
+    they were when the client connected.
+    """
+
+    subtotals = {}
+
+    def message(symbol, price):
+        subtotals[symbol] = price * holdings[symbol]
+        data = {"symbol": symbol, "price": price,
+                "subtotal": subtotals[symbol]}
+        if len(subtotals) == len(holdings):
+            data["total"] = cash + sum(subtotals.values())
+        return f"event: price\ndata: {json.dumps(data)}\n\n"
+
+    pending = hub.subscribe(holdings)
+    try:
+        # Send prices already known so the page is current straight away
+        for symbol in holdings:
+            if symbol in hub.prices:
+                yield message(symbol, hub.prices[symbol])
+
+        while True:
+            try:
+                symbol, price = pending.get(timeout=heartbeat)
+            except queue.Empty:
+                # Comment lines keep the connection open through proxies
+                yield ": heartbeat\n\n"
+                continue
+            yield message(symbol, price)
+    finally:
+        hub.unsubscribe(pending, holdings)
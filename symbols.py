@@ -0,0 +1,133 @@
+"""A local directory of stock symbols for validation and autocomplete.
+
+Symbols come from a bundled listing file, a CSV of symbol and name, merged
+with the stocks table. They are kept in sorted arrays so prefix searches of
+symbols, and of each word of company names, are binary searches.
+"""
+
+import csv
+import difflib
+import threading
+from bisect import bisect_left, insort
+
+from models import db, Stock
+
+
+class SymbolDirectory:
+    """Sorted, in-memory index of listed symbols and company names.
+
+    extra maps any further symbols to list, such as a simulated market's, to
+    their names.
+    """
+
+    def __init__(self, path, extra=None):
+        self.path = path
+        self.extra = extra or {}
+        self.names = {}
+        self._symbols = []
+        self._words = []
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def __len__(self):
+        self.load()
+        return len(self._symbols)
+
+    def load(self):
+        """Read the listing file and stocks table, once per process."""
+
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            names = {}
+            with open(self.path, newline="") as listing:
+                for row in csv.DictReader(listing):
+                    names[row["symbol"].strip().upper()] = row["name"].strip()
+            for symbol, name in self.extra.items():
+                names.setdefault(symbol, name)
+            for symbol, name in db.session.query(Stock.symbol, Stock.name).\
+                    filter(Stock.symbol.isnot(None)):
+                names.setdefault(symbol, name)
+            self._index(names)
+            self._loaded = True
+
+    def add(self, symbol, name):
+        """Add a symbol found upstream, such as a newly bought stock.
+
+        Each is inserted in place, in O(n) moves rather than a re-sort. A
+        directory not yet loaded will read it from the stocks table.
+        """
+
+        if not self._loaded:
+            return
+        with self._lock:
+            if symbol in self.names:
+                return
+            self.names[symbol] = name
+            insort(self._symbols, symbol)
+            for word in set(name.lower().split()):
+                insort(self._words, (word, symbol))
+
+    def _index(self, names):
+        """Rebuild the sorted arrays from a dict of symbol to name."""
+
+        words = []
+        for symbol, name in names.items():
+            for word in set(name.lower().split()):
+                words.append((word, symbol))
+        words.sort()
+        self.names = names
+        self._symbols = sorted(names)
+        self._words = words
+
+    def known(self, symbol):
+        """Return whether symbol is listed."""
+
+        self.load()
+        return symbol.upper() in self.names
+
+    def search(self, query, limit=10):
+        """Return up to limit listings matching query.
+
+        Symbols starting with query come first, then companies with a word
+        in their name starting with it, then, if still short, symbols close
+        to query to allow for typos.
+        """
+
+        self.load()
+        query = query.strip()
+        if not query:
+            return []
+        found = []
+
+        # Symbols starting with the query
+        prefix = query.upper()
+        i = bisect_left(self._symbols, prefix)
+        while (i < len(self._symbols) and len(found) < limit
+               and self._symbols[i].startswith(prefix)):
+            found.append(self._symbols[i])
+            i += 1
+
+        # Names with a word starting with the query
+        prefix = query.lower()
+        i = bisect_left(self._words, (prefix,))
+        while (i < len(self._words) and len(found) < limit
+               and self._words[i][0].startswith(prefix)):
+            if self._words[i][1] not in found:
+                found.append(self._words[i][1])
+            i += 1
+
+        # Similar symbols sharing the first letter
+        if len(found) < limit:
+            first = query[0].upper()
+            start = bisect_left(self._symbols, first)
+            end = bisect_left(self._symbols, chr(ord(first) + 1))
+            for symbol in difflib.get_close_matches(
+                    query.upper(), self._symbols[start:end], limit, 0.6):
+                if symbol not in found:
+                    found.append(symbol)
+
+        return [{"symbol": symbol, "name": self.names[symbol]}
+                for symbol in found[:limit]]
@@ -0,0 +1,103 @@
+"""Tests for the read replica routing in database.py."""
+
+import os
+import sqlite3
+import threading
+
+import pytest
+from sqlalchemy import event
+
+from application import create_app
+from database import REPLICA
+from migrations import upgrade
+from models import bootstrap, db
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Return an app on a primary database and a replica of it."""
+
+    primary = os.path.join(tmp_path, "primary.db")
+    replica = os.path.join(tmp_path, "replica.db")
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///" + primary)
+    monkeypatch.setenv("DATABASE_REPLICA_URL", "sqlite:///" + replica)
+    monkeypatch.setenv("DATABASE_ECHO", "0")
+    monkeypatch.setenv("QUOTE_PROVIDER", "simulated")
+    app = create_app({
+        "TESTING": True,
+        "SHARED_STORE": os.path.join(tmp_path, "shared.db"),
+        "JOBS_DB": os.path.join(tmp_path, "jobs.db"),
+        "JOBS_WORKERS": 0,
+        "BARS_DIR": os.path.join(tmp_path, "bars"),
+        "EXPORTS_DIR": os.path.join(tmp_path, "exports"),
+        "ORDER_ENGINE_LOCK": os.path.join(tmp_path, "order-engine.lock"),
+    })
+    with app.app_context():
+        bootstrap()
+        upgrade()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    """Return a client logged in as a user who holds a stock, with the
+    replica brought up to date with the primary."""
+
+    client = app.test_client()
+    client.post("/register", data={"username": "reader",
+                                   "password": "Passw0rd1",
+                                   "confirmation": "Passw0rd1"})
+    client.post("/buy", data={"symbol": "AAPL", "shares": "2"})
+    with app.app_context():
+        source = sqlite3.connect(db.engines[None].url.database)
+        target = sqlite3.connect(db.engines[REPLICA].url.database)
+        source.backup(target)
+        source.close()
+        target.close()
+    return client
+
+
+@pytest.fixture
+def executed(app, client):
+    """Return the statements each engine runs for the test's requests.
+
+    Counted once the client is set up, and only from this thread, not the
+    order engine's.
+    """
+
+    executed = {"primary": [], "replica": []}
+    with app.app_context():
+        engines = {"primary": db.engines[None],
+                   "replica": db.engines[REPLICA]}
+    for name, engine in engines.items():
+        def record(conn, cursor, statement, *args, name=name):
+            if threading.current_thread() is threading.main_thread():
+                executed[name].append(statement)
+        event.listen(engine, "before_cursor_execute", record)
+    return executed
+
+
+@pytest.mark.parametrize("method, path, data", [
+    ("get", "/", None),
+    ("get", "/history", None),
+    ("post", "/quote", {"symbol": "AAPL"}),
+])
+def test_read_only_routes_read_from_the_replica(client, executed, method,
+                                                path, data):
+    response = getattr(client, method)(path, data=data)
+    assert response.status_code == 200
+    assert executed["primary"] == []
+    if path != "/quote":
+        assert executed["replica"]
+
+
+def test_trades_write_to_the_primary(client, executed):
+    response = client.post("/buy", data={"symbol": "AAPL", "shares": "1"})
+    assert response.status_code == 302
+    assert executed["replica"] == []
+    assert any(statement.startswith("INSERT INTO transactions")
+               for statement in executed["primary"])
@@ -0,0 +1,130 @@
+"""Tests for the idempotency keys of trade submissions in idempotency.py."""
+
+import os
+import threading
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from application import create_app
+from idempotency import FIELD, fingerprint
+from migrations import upgrade
+from models import bootstrap, db, IdempotencyKey, Transaction
+
+KEY = "0123456789abcdef"
+BUY = {"symbol": "AAPL", "shares": "1", FIELD: KEY}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Return an app on a temporary database, quoting a simulated market."""
+
+    monkeypatch.setenv("QUOTE_PROVIDER", "simulated")
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+                                   + os.path.join(tmp_path, "finance.db"),
+        "SQLALCHEMY_ECHO": False,
+        "SHARED_STORE": os.path.join(tmp_path, "shared.db"),
+        "JOBS_DB": os.path.join(tmp_path, "jobs.db"),
+        "JOBS_WORKERS": 0,
+        "BARS_DIR": os.path.join(tmp_path, "bars"),
+        "EXPORTS_DIR": os.path.join(tmp_path, "exports"),
+        "ORDER_ENGINE_LOCK": os.path.join(tmp_path, "order-engine.lock"),
+    })
+    with app.app_context():
+        bootstrap()
+        upgrade()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    """Return a client logged in as a newly registered user."""
+
+    client = app.test_client()
+    client.post("/register", data={"username": "trader",
+                                   "password": "Passw0rd1",
+                                   "confirmation": "Passw0rd1"})
+    return client
+
+
+def trades(app):
+    """Return the number of transactions recorded."""
+
+    with app.app_context():
+        return Transaction.query.count()
+
+
+def test_repeat_gets_the_stored_response(app, client):
+    first = client.post("/buy", data=BUY)
+    assert first.status_code == 302
+    with app.app_context():
+        row = IdempotencyKey.query.filter_by(key=KEY).one()
+        assert row.status == 302
+        assert row.location == first.headers["Location"]
+
+    repeat = client.post("/buy", data=BUY)
+    assert repeat.status_code == 302
+    assert repeat.headers["Location"] == first.headers["Location"]
+    assert repeat.get_data() == first.get_data()
+    assert trades(app) == 1
+
+
+def test_repeat_while_in_flight_conflicts(app, client):
+    with app.test_request_context("/buy", method="POST", data=BUY):
+        digest = fingerprint()
+    with app.app_context():
+        db.session.add(IdempotencyKey(
+            user_id=1, key=KEY, path="/buy", fingerprint=digest,
+            expires=datetime.max))
+        db.session.commit()
+
+    response = client.post("/buy", data=BUY)
+    assert response.status_code == 409
+    assert trades(app) == 0
+
+
+def test_key_reused_for_another_request_is_rejected(app, client):
+    assert client.post("/buy", data=BUY).status_code == 302
+    assert client.post("/buy", data={**BUY, "shares": "2"}).status_code \
+        == 422
+    assert client.post("/sell", data=BUY).status_code == 422
+    assert trades(app) == 1
+
+
+def test_failed_submission_releases_its_key(app, client):
+    unaffordable = {**BUY, "shares": "1000000"}
+    assert client.post("/buy", data=unaffordable).status_code == 403
+    with app.app_context():
+        assert IdempotencyKey.query.filter_by(key=KEY).first() is None
+
+    client.post("/deposit", data={"amount": "1000000000",
+                                  "password": "Passw0rd1"})
+    assert client.post("/buy", data=unaffordable).status_code == 302
+    assert trades(app) == 2
+
+
+
+def test_response_is_stored_with_the_trade(app, client):
+    # A commit of its own after the trade's would leave a window in which a
+    # crash keeps the key claimed, answered with 409 until it expires
+    commits = []
+
+    def committed(session):
+        if threading.current_thread() is threading.main_thread():
+            commits.append(session)
+
+    event.listen(Session, "after_commit", committed)
+    try:
+        assert client.post("/buy", data=BUY).status_code == 302
+    finally:
+        event.remove(Session, "after_commit", committed)
+
+    # One claiming the key, then one for the trade and its response
+    assert len(commits) == 2
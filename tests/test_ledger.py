@@ -0,0 +1,78 @@
+"""Tests for the double-entry ledger in ledger.py."""
+
+import os
+from decimal import Decimal
+
+import pytest
+
+from application import create_app
+from ledger import balance, reconcile
+from migrations import upgrade
+from models import bootstrap, db, Portfolio, User
+
+PASSWORD = "Passw0rd1"
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Return an app on a temporary database, quoting a simulated market."""
+
+    monkeypatch.setenv("QUOTE_PROVIDER", "simulated")
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+                                   + os.path.join(tmp_path, "finance.db"),
+        "SQLALCHEMY_ECHO": False,
+        "SHARED_STORE": os.path.join(tmp_path, "shared.db"),
+        "JOBS_DB": os.path.join(tmp_path, "jobs.db"),
+        "JOBS_WORKERS": 0,
+        "BARS_DIR": os.path.join(tmp_path, "bars"),
+        "EXPORTS_DIR": os.path.join(tmp_path, "exports"),
+        "ORDER_ENGINE_LOCK": os.path.join(tmp_path, "order-engine.lock"),
+    })
+    with app.app_context():
+        bootstrap()
+        upgrade()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+def trade(client):
+    """Buy, sell, deposit and withdraw, checking each succeeds."""
+
+    for path, data in (("/buy", {"symbol": "AAPL", "shares": "3"}),
+                       ("/buy", {"symbol": "MSFT", "shares": "2"}),
+                       ("/sell", {"symbol": "AAPL", "shares": "1"}),
+                       ("/deposit", {"amount": "250.50",
+                                     "password": PASSWORD}),
+                       ("/withdraw", {"amount": "100",
+                                      "password": PASSWORD}),
+                       ("/sell", {"symbol": "MSFT", "shares": "2"})):
+        assert client.post(path, data=data).status_code == 302, path
+
+
+def assert_balanced(user_id):
+    """Check the ledger agrees with the user's cash and portfolio."""
+
+    assert reconcile() == []
+    user = db.session.get(User, user_id)
+    held = {row.stock_id: row.quantity
+            for row in Portfolio.query.filter_by(user_id=user_id)}
+    assert balance(user_id) == (Decimal(user.cash), held)
+
+
+def test_trades_and_cash_movements_keep_the_ledger_balanced(app):
+    client = app.test_client()
+    client.post("/register", data={"username": "trader",
+                                   "password": PASSWORD,
+                                   "confirmation": PASSWORD})
+    trade(client)
+    with app.app_context():
+        assert_balanced(1)
+
+    # Again from the checkpoint the first reconciliation wrote
+    trade(client)
+    with app.app_context():
+        assert_balanced(1)
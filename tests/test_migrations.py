@@ -0,0 +1,70 @@
+"""Tests for the versioned migrations in migrations.py."""
+
+import os
+
+import pytest
+from sqlalchemy import text
+
+from application import create_app
+from migrations import explain_hot_queries, upgrade
+from models import bootstrap, db
+
+
+@pytest.fixture
+def app(tmp_path):
+    """Return an app on a temporary database, with its tables not created."""
+
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+                                   + os.path.join(tmp_path, "finance.db"),
+        "SHARED_STORE": os.path.join(tmp_path, "shared.db"),
+        "JOBS_DB": os.path.join(tmp_path, "jobs.db"),
+        "JOBS_WORKERS": 0,
+        "BARS_DIR": os.path.join(tmp_path, "bars"),
+        "EXPORTS_DIR": os.path.join(tmp_path, "exports"),
+        "ORDER_ENGINE_LOCK": os.path.join(tmp_path, "order-engine.lock"),
+    })
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+def test_hot_queries_use_their_indexes(app):
+    bootstrap()
+    assert upgrade() == [1, 2, 3, 4]
+    results = explain_hot_queries()
+    assert len(results) > 0
+    for route, sql, index, plan, ok in results:
+        assert ok, f"{route}: {sql} does not use {index}: {plan}"
+
+
+def test_upgrade_is_idempotent(app):
+    bootstrap()
+    upgrade()
+    assert upgrade() == []
+
+
+def test_duplicate_holdings_are_merged_before_unique_index(app):
+    bootstrap()
+
+    # A database from before migration 1 has no unique index on portfolios
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_portfolios_user_stock"))
+        conn.execute(text(
+            "INSERT INTO users (id, username, hash, cash) "
+            "VALUES (1, 'a', 'x', 10000)"))
+        conn.execute(text(
+            "INSERT INTO stocks (id, symbol, name) "
+            "VALUES (1, 'AAPL', 'Apple'), (2, 'MSFT', 'Microsoft')"))
+        conn.execute(text(
+            "INSERT INTO portfolios (id, user_id, stock_id, quantity) "
+            "VALUES (1, 1, 1, 2), (2, 1, 2, 5), (3, 1, 1, 3), (4, 1, 1, 4)"))
+
+    upgrade()
+
+    with db.engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT id, stock_id, quantity FROM portfolios ORDER BY id")).all()
+    assert [tuple(row) for row in rows] == [(1, 1, 9), (2, 2, 5)]
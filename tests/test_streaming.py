@@ -0,0 +1,48 @@
+"""Tests for the price hub's fan-out to connected clients."""
+
+from streaming import PriceHub, portfolio_events
+
+CLIENTS = 5000
+
+
+def hub():
+    """Return a price hub that never polls, prices being published by hand."""
+
+    hub = PriceHub(None)
+    hub._start = lambda: None
+    return hub
+
+
+def test_publish_reaches_only_subscribers_of_the_symbol():
+    prices = hub()
+    apple = prices.subscribe(["AAPL"])
+    microsoft = prices.subscribe(["MSFT"])
+    prices.publish("AAPL", 10.0)
+    prices.publish("AAPL", 10.0)
+    assert apple.get_nowait() == ("AAPL", 10.0)
+    assert apple.empty() and microsoft.empty()
+
+
+def test_fan_out_to_5k_clients():
+    prices = hub()
+    prices.prices["MSFT"] = 20.0
+    clients = [portfolio_events(prices, {"AAPL": 2, "MSFT": 1}, 100.0)
+               for _ in range(CLIENTS)]
+
+    # Each client subscribes and is sent the known price on connecting
+    for client in clients:
+        assert '"symbol": "MSFT"' in next(client)
+    assert len(prices._subscribers["AAPL"]) == CLIENTS
+    assert len(prices._subscribers["MSFT"]) == CLIENTS
+
+    # One change reaches every client once, with their new total
+    prices.publish("AAPL", 10.0)
+    for client in clients:
+        assert '"total": 140.0' in next(client)
+    assert all(pending.empty() for pending in prices._subscribers["AAPL"])
+
+    # Disconnecting unsubscribes, and unwatched prices are forgotten
+    for client in clients:
+        client.close()
+    assert not prices._subscribers
+    assert "AAPL" not in prices.prices
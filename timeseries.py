@@ -0,0 +1,156 @@
+"""Compact per-symbol OHLC price history.
+
+Each symbol's minute bars are stored as fixed-width columns, one file per
+field, appended to in time order:
+
+    <root>/<SYMBOL>/time     int64 seconds since the epoch
+    <root>/<SYMBOL>/open     float32, likewise high, low and close
+    <root>/<SYMBOL>/volume   int64
+
+Reads memory-map the columns, so a range query binary searches the time
+column and only pages in the bars it covers. Downsampling reduces each
+bucket of bars with min, max and sum over zero-copy slices.
+"""
+
+import mmap
+import os
+import os.path
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Field name and array typecode of each column
+COLUMNS = (("time", "q"), ("open", "f"), ("high", "f"), ("low", "f"),
+           ("close", "f"), ("volume", "q"))
+
+
+class BarStore:
+    """Append-only columnar store of OHLC bars per symbol."""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, symbol, column):
+        return os.path.join(self.root, symbol.upper(), column)
+
+    def append(self, symbol, bars):
+        """Append (time, open, high, low, close, volume) bars.
+
+        Bars must be in time order, any not after the last stored are
+        dropped. The time column is written last so readers never see a bar
+        whose other fields are missing.
+        """
+
+        with self._lock:
+            last = self.last_time(symbol)
+            columns = [array(code) for _, code in COLUMNS]
+            for bar in bars:
+                if last is not None and bar[0] <= last:
+                    continue
+                last = bar[0]
+                for column, value in zip(columns, bar):
+                    column.append(value)
+            if not columns[0]:
+                return
+            os.makedirs(os.path.join(self.root, symbol.upper()),
+                        exist_ok=True)
+            for (name, _), column in reversed(list(zip(COLUMNS, columns))):
+                with open(self._path(symbol, name), "ab") as f:
+                    column.tofile(f)
+
+    def last_time(self, symbol):
+        """Return the time of the latest stored bar, or None."""
+
+        views = self.columns(symbol)
+        if not views or not len(views["time"]):
+            return None
+        return views["time"][-1]
+
+    def columns(self, symbol):
+        """Map each column of symbol as a typed memoryview, or return None."""
+
+        views = {}
+        length = None
+        for name, code in COLUMNS:
+            path = self._path(symbol, name)
+            try:
+                with open(path, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if not size:
+                        return None
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                return None
+            view = memoryview(mapped).cast(code)
+            views[name] = view
+            length = len(view) if length is None else min(length, len(view))
+
+        # Ignore any bar partly written by a concurrent append
+        return {name: view[:length] for name, view in views.items()}
+
+    def range(self, symbol, start, end):
+        """Return the bars with start <= time <= end."""
+
+        views = self.columns(symbol)
+        if not views:
+            return []
+        i, j = self._bounds(views["time"], start, end)
+        return list(zip(*(views[name][i:j].tolist() for name, _ in COLUMNS)))
+
+    def downsample(self, symbol, start, end, points):
+        """Return at most points bars aggregating those in start to end.
+
+        Each returned bar covers an equal share of the stored bars, taking
+        the first open and time, the last close, the highest high, the
+        lowest low and the total volume.
+        """
+
+        views = self.columns(symbol)
+        if not views:
+            return []
+        i, j = self._bounds(views["time"], start, end)
+        if j - i <= points:
+            return self.range(symbol, start, end)
+
+        bars = []
+        for bucket in range(points):
+            a = i + (j - i) * bucket // points
+            b = i + (j - i) * (bucket + 1) // points
+            bars.append((views["time"][a], views["open"][a],
+                         max(views["high"][a:b]), min(views["low"][a:b]),
+                         views["close"][b - 1], sum(views["volume"][a:b])))
+        return bars
+
+    @staticmethod
+    def _bounds(times, start, end):
+        """Return the slice of times between start and end inclusive."""
+
+        i = 0 if start is None else bisect_left(times, start)
+        j = len(times) if end is None else bisect_right(times, end)
+        return i, j
+
+
+class BarRecorder:
+    """Builds minute bars from the prices published by the price hub."""
+
+    def __init__(self, store, clock):
+        self.store = store
+        self.clock = clock
+        self._bars = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, symbol, price):
+        """Add a price, storing the symbol's previous bar once it closes."""
+
+        minute = int(self.clock()) // 60 * 60
+        with self._lock:
+            bar = self._bars.get(symbol)
+            if bar and bar[0] == minute:
+                bar[2] = max(bar[2], price)
+                bar[3] = min(bar[3], price)
+                bar[4] = price
+                return
+            self._bars[symbol] = [minute, price, price, price, price, 0]
+        if bar:
+            self.store.append(symbol, [bar])